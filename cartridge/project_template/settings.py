@@ -80,7 +80,7 @@
 #     ("Content", ("pages.Page", "blog.BlogPost",
 #        "generic.ThreadedComment", ("Media Library", "fb_browse"),)),
 #     ("Shop", ("shop.Product", "shop.ProductOption", "shop.DiscountCode",
-#         "shop.Sale", "shop.Order")),
+#         "shop.Sale", "shop.Order", "shop.SalesSummary")),
 #     ("Site", ("sites.Site", "redirects.Redirect", "conf.Setting")),
 #     ("Users", ("auth.User", "auth.Group",)),
 # )
@@ -347,6 +347,7 @@ MIDDLEWARE_CLASSES = (
     "mezzanine.core.middleware.DeviceAwareFetchFromCacheMiddleware",
     "mezzanine.core.middleware.AdminLoginInterfaceSelectorMiddleware",
     "mezzanine.core.middleware.SSLRedirectMiddleware",
+    "mezzanine.pages.middleware.PageMiddleware",
     "cartridge.shop.middleware.ShopMiddleware",
 )
 
@@ -14,7 +14,7 @@ from cartridge.shop.forms import ProductVariationAdminFormset
 from cartridge.shop.forms import DiscountAdminForm, ImageWidget, MoneyWidget
 from cartridge.shop.models import Category, Product, ProductImage
 from cartridge.shop.models import ProductVariation, ProductOption, Order
-from cartridge.shop.models import OrderItem, Sale, DiscountCode
+from cartridge.shop.models import OrderItem, Sale, DiscountCode, SalesSummary
 
 
 # Lists of field names.
@@ -194,7 +194,7 @@ class OrderAdmin(admin.ModelAdmin):
 
 class SaleAdmin(admin.ModelAdmin):
     list_display = ("title", "active", "discount_deduct", "discount_percent",
-        "discount_exact", "valid_from", "valid_to")
+        "discount_exact", "valid_from", "valid_to", "update_progress_display")
     list_editable = ("active", "discount_deduct", "discount_percent",
         "discount_exact", "valid_from", "valid_to")
     filter_horizontal = ("categories", "products")
@@ -231,9 +231,26 @@ class DiscountCodeAdmin(admin.ModelAdmin):
     )
 
 
+class SalesSummaryAdmin(admin.ModelAdmin):
+    list_display = ("date", "dimension", "description", "orders",
+                    "quantity", "revenue", "discount_total")
+    list_filter = ("dimension",)
+    search_fields = ("key", "description")
+    date_hierarchy = "date"
+    readonly_fields = ("date", "dimension", "key", "description", "orders",
+                       "quantity", "revenue", "discount_total")
+
+    def has_add_permission(self, request):
+        """
+        Summaries are only added from completed orders.
+        """
+        return False
+
+
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(ProductOption, ProductOptionAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Sale, SaleAdmin)
 admin.site.register(DiscountCode, DiscountCodeAdmin)
+admin.site.register(SalesSummary, SalesSummaryAdmin)
@@ -21,7 +21,7 @@ register_setting(
         (_("Content"), ("pages.Page", "blog.BlogPost",
             "generic.ThreadedComment", (_("Media Library"), "fb_browse"),)),
         (_("Shop"), ("shop.Product", "shop.ProductOption", "shop.DiscountCode",
-            "shop.Sale", "shop.Order")),
+            "shop.Sale", "shop.Order", "shop.SalesSummary")),
         (_("Site"), ("sites.Site", "redirects.Redirect", "conf.Setting")),
         (_("Users"), ("auth.User", "auth.Group",)),
     ),
@@ -66,11 +66,45 @@ register_setting(
 
 register_setting(
     name="SHOP_CART_EXPIRY_MINUTES",
-    description="Number of minutes of inactivity until carts are abandoned.",
+    description="Number of minutes of inactivity until carts are abandoned. "
+        "Abandoned carts are deleted by the ``delete_expired_carts`` "
+        "management command, which must be scheduled to run "
+        "periodically.",
     editable=False,
     default=30,
 )
 
+register_setting(
+    name="SHOP_CART_SESSION_STORAGE",
+    description="If True, carts for anonymous users are kept in their "
+        "session and only stored in the database once the cart is "
+        "edited or checked out. Stock isn't held for the items in these "
+        "carts until they're stored.",
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="SHOP_CART_TOUCH_FRACTION",
+    description="Fraction of ``SHOP_CART_EXPIRY_MINUTES`` that a cart's "
+        "last updated time can be behind by before it's saved again when "
+        "the cart is used. Higher values save the time less often. Carts "
+        "are kept for this much longer than the expiry minutes so they "
+        "never expire early.",
+    editable=False,
+    default=0.1,
+)
+
+register_setting(
+    name="SHOP_CATEGORY_KEYSET_PAGING",
+    description="If True, category pages link to the next and previous "
+        "pages by the last and first products shown rather than by page "
+        "number, so that deep pages are as fast to load as the first. "
+        "The total number of products for the category is cached.",
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="SHOP_CHECKOUT_ACCOUNT_REQUIRED",
     label=_("Checkout account required"),
@@ -224,6 +258,40 @@ register_setting(
     default=12,
 )
 
+register_setting(
+    name="SHOP_POPULARITY_HALF_LIFE",
+    description="Number of days after which products being added to "
+        "carts and purchased count for half as much towards the "
+        "popularity of products, used for the \"Most popular\" sort "
+        "option.",
+    editable=False,
+    default=7,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_ACTION_FLUSH_SECONDS",
+    description="Number of seconds that each process buffers counts for "
+        "products being added to carts and purchased, before writing "
+        "them to the database once a request has finished. Set to 0 to "
+        "write them immediately.",
+    editable=False,
+    default=60,
+)
+
+register_setting(
+    name="SHOP_PRODUCT_CACHE_SECONDS",
+    description="Number of seconds that the product, variations, images, "
+        "related products and options shown on each product's page are "
+        "cached for, for users who aren't staff. They're removed from "
+        "the cache when they're changed, which requires a cache backend "
+        "shared by all processes, such as memcached, otherwise other "
+        "processes show the old details until they expire. The stock "
+        "levels and prices of variations are always read from the "
+        "database. Set to 0 to disable, which is the default.",
+    editable=False,
+    default=0,
+)
+
 register_setting(
     name="SHOP_PRODUCT_SORT_OPTIONS",
     description="Sequence of description/field+direction pairs defining "
@@ -231,8 +299,19 @@ register_setting(
     editable=False,
     default=(
         (_("Recently added"), "-date_added"),
+        (_("Most popular"), "-popularity"),
         (_("Highest rated"), "-rating_average"),
-        (_("Least expensive"), "unit_price"),
-        (_("Most expensive"), "-unit_price"),
+        (_("Least expensive"), "effective_price"),
+        (_("Most expensive"), "-effective_price"),
     ),
 )
+
+register_setting(
+    name="SHOP_SALE_BACKGROUND_UPDATE",
+    description="If True, saving a sale doesn't update its products and "
+        "variations, which are instead updated in chunks by the "
+        "``apply_sales`` management command, so that large sales can be "
+        "saved without the request timing out.",
+    editable=False,
+    default=False,
+)
@@ -52,11 +52,20 @@ class AddProductForm(forms.Form):
         If a product is being added to the cart, then its stock
         level is also validated.
 
+        The product's variations can be given with the ``variations``
+        keyword arg, with current stock levels such as those returned
+        by ``ProductManager.details``, along with the values for each
+        option with the ``options`` keyword arg, otherwise they're
+        retrieved once and reused. The chosen variation is then found
+        among them without querying them again.
+
         When adding to the cart from the wishlist page, a sku is
         given for the variation, so the creation of choice fields
         is skipped.
         """
         self._product = kwargs.pop("product", None)
+        self._variations = kwargs.pop("variations", None)
+        options = kwargs.pop("options", None)
         self._to_cart = kwargs.pop("to_cart")
         super(AddProductForm, self).__init__(*xargs, **kwargs)
         # Adding from the wishlist with a sku, bail out.
@@ -65,17 +74,16 @@ class AddProductForm(forms.Form):
         # Adding from the product page, remove the sku field
         # and build the choice fields for the variations.
         del self.fields["sku"]
-        option_names, option_labels = zip(*[(f.name, f.verbose_name)
-            for f in ProductVariation.option_fields()])
-        option_values = zip(*self._product.variations.filter(
-            unit_price__isnull=False).values_list(*option_names))
-        if option_values:
-            for i, name in enumerate(option_names):
-                values = filter(None, set(option_values[i]))
-                if values:
-                    field = forms.ChoiceField(label=option_labels[i],
-                                              choices=make_choices(values))
-                    self.fields[name] = field
+        if self._variations is None:
+            self._variations = list(self._product.variations.all())
+        if options is None:
+            options = ProductVariation.option_values(self._variations)
+        option_labels = dict([(f.name, f.verbose_name)
+                              for f in ProductVariation.option_fields()])
+        for name, values in options:
+            field = forms.ChoiceField(label=option_labels[name],
+                                      choices=make_choices(values))
+            self.fields[name] = field
 
     def clean(self):
         """
@@ -88,33 +96,72 @@ class AddProductForm(forms.Form):
         # a variation.
         data = self.cleaned_data.copy()
         quantity = data.pop("quantity")
-        # Ensure the product has a price if adding to cart.
-        if self._to_cart:
-            data["unit_price__isnull"] = False
         error = None
-        if self._product is not None:
-            # Chosen options will be passed to the product's
+        if self._variations is not None:
+            # Chosen options are matched against the product's
             # variations.
-            qs = self._product.variations
-        else:
-            # A product hasn't been given since we have a direct sku.
-            qs = ProductVariation.objects
-        try:
-            variation = qs.get(**data)
-        except ProductVariation.DoesNotExist:
-            error = "invalid_options"
+            variation = self._variation_from_options(data)
+            if variation is not None and self._to_cart:
+                variation = self._current_variation(variation)
         else:
-            # Validate stock if adding to cart.
+            # Ensure the product has a price if adding to cart.
             if self._to_cart:
-                if not variation.has_stock():
-                    error = "no_stock"
-                elif not variation.has_stock(quantity):
-                    error = "no_stock_quantity"
+                data["unit_price__isnull"] = False
+            if self._product is not None:
+                qs = self._product.variations
+            else:
+                # A product hasn't been given since we have a direct sku.
+                qs = ProductVariation.objects
+            try:
+                variation = qs.get(**data)
+            except ProductVariation.DoesNotExist:
+                variation = None
+        if variation is None:
+            error = "invalid_options"
+        # Validate stock if adding to cart.
+        elif self._to_cart:
+            if not variation.has_stock():
+                error = "no_stock"
+            elif not variation.has_stock(quantity):
+                error = "no_stock_quantity"
         if error is not None:
             raise forms.ValidationError(ADD_PRODUCT_ERRORS[error])
         self.variation = variation
         return self.cleaned_data
 
+    def _variation_from_options(self, options):
+        """
+        Returns the product's variation matching the chosen options,
+        or ``None`` if there isn't exactly one, or it doesn't have a
+        price when adding to the cart.
+        """
+        matches = [v for v in self._variations
+                   if all([getattr(v, name) == value
+                           for name, value in options.items()])]
+        if self._to_cart:
+            matches = [v for v in matches if v.unit_price is not None]
+        if len(matches) != 1:
+            return None
+        return matches[0]
+
+    def _current_variation(self, variation):
+        """
+        Returns the given variation read again from the database, or
+        ``None`` if it no longer exists or has no price, since the
+        variations given may be cached and the variation is about to
+        be added to the cart with its price. The product and image
+        already retrieved are assigned to it.
+        """
+        try:
+            current = ProductVariation.objects.get(id=variation.id,
+                                                   unit_price__isnull=False)
+        except ProductVariation.DoesNotExist:
+            return None
+        current.product = self._product
+        if variation.image_id is not None:
+            current.image = variation.image
+        return current
+
 
 class CartItemForm(forms.ModelForm):
     """
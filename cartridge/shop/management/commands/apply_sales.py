@@ -0,0 +1,31 @@
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.managers import BULK_BATCH_SIZE
+from cartridge.shop.models import Sale
+
+
+class Command(NoArgsCommand):
+    help = _("Updates the products and variations for sales that were "
+             "saved with the SHOP_SALE_BACKGROUND_UPDATE setting, or "
+             "whose update was interrupted, in chunks that are each "
+             "committed separately.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--chunk-size",
+            dest="chunk_size",
+            type="int",
+            default=BULK_BATCH_SIZE,
+            help=_("Number of products or variations checked per chunk.")),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        for sale in Sale.objects.filter(update_progress__isnull=False):
+            written = sale.update_products(chunk_size=options["chunk_size"])
+            if verbosity >= 1:
+                print _("%(sale)s: updated %(count)s products and "
+                        "variations") % {"sale": sale, "count": written}
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.managers import BULK_BATCH_SIZE
+from cartridge.shop.models import Cart
+
+
+class Command(NoArgsCommand):
+    help = _("Deletes carts that have expired, along with their items. "
+             "Should be run periodically, such as from cron.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size",
+            action="store",
+            type="int",
+            dest="batch_size",
+            default=BULK_BATCH_SIZE,
+            help=_("Number of carts to delete per transaction.")),
+    )
+
+    def handle_noargs(self, **options):
+        total = Cart.objects.delete_expired(options["batch_size"])
+        if int(options.get("verbosity", 1)) >= 1:
+            print _("Deleted %s expired carts") % total
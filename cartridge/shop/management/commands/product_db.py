@@ -1,15 +1,27 @@
 import csv
+import gzip
 import os
 import shutil
+import sys
 import datetime
+from decimal import Decimal
+from itertools import islice
+from multiprocessing import Process, Queue
 from optparse import make_option
+from Queue import Full
+from time import time
 
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 from django.utils.translation import ugettext as _
-from django.db.utils import IntegrityError
+from django.db import connection, models, transaction
+from django.db.models import Count
 from mezzanine.conf import settings
+from mezzanine.utils.timezone import make_aware
 
+from cartridge.shop.managers import BULK_BATCH_SIZE
+from cartridge.shop.models import CategoryProduct
+from cartridge.shop.models import Priced
 from cartridge.shop.models import Product
 from cartridge.shop.models import ProductOption
 from cartridge.shop.models import ProductImage
@@ -44,6 +56,13 @@ SALE_END_DATE = _("Sale End Date")
 SALE_END_TIME = _("Sale End Time")
 
 DATETIME_FORMAT = "%s %s" % (DATE_FORMAT, TIME_FORMAT)
+# Number of rows read and written per transaction when importing.
+IMPORT_CHUNK_SIZE = BULK_BATCH_SIZE
+# Number of chunks queued for each worker when importing in parallel,
+# beyond which reading the csv file waits for the worker to catch up.
+IMPORT_QUEUE_SIZE = 4
+# Number of variations read per query when exporting.
+EXPORT_CHUNK_SIZE = BULK_BATCH_SIZE
 SITE_MEDIA_IMAGE_DIR = _("product")
 PRODUCT_IMAGE_DIR = os.path.join(settings.STATIC_ROOT, SITE_MEDIA_IMAGE_DIR)
 # python < 2.7 doesn't have dictionary comprehensions ;(
@@ -61,7 +80,8 @@ fieldnames += TYPE_CHOICES.keys()
 
 class Command(BaseCommand):
     args = '--import/--export <csv_file>'
-    help = _('Import/Export products from a csv file.')
+    help = _('Import/Export products from a csv file. Use - for '
+             'stdin/stdout, and a .gz extension for gzipped files.')
 
     option_list = BaseCommand.option_list + (
         make_option('--import',
@@ -74,6 +94,25 @@ class Command(BaseCommand):
             dest='export',
             default=False,
             help=_('Export products from csv file.')),
+        make_option('--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=IMPORT_CHUNK_SIZE,
+            help=_('Number of rows to import or export at a time.')),
+        make_option('--sync',
+            action='store_true',
+            dest='sync',
+            default=False,
+            help=_('Update products with existing SKUs when importing.')),
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help=_('Number of processes to import with in parallel. '
+                   'Requires a database that supports concurrent writes, '
+                   'such as PostgreSQL.')),
     )
 
     def handle(self, *args, **options):
@@ -86,27 +125,52 @@ class Command(BaseCommand):
         if not options["import"] and not options["export"]:
             raise CommandError(_("need to import or export"))
         if options['import']:
-            import_products(csv_file)
+            import_products(csv_file, options["chunk_size"],
+                            options["sync"], options["workers"])
         elif options['export']:
-            export_products(csv_file)
-
-
-def _product_from_row(row):
-    product, created = Product.objects.get_or_create(title=row[TITLE])
-    product.content = row[CONTENT]
-    product.description = row[DESCRIPTION]
-    # TODO: set the 2 below from spreadsheet.
-    product.status = CONTENT_STATUS_PUBLISHED
-    product.available = True
-    # TODO: allow arbitrary level/number of categories.
-    base_cat, created = Category.objects.get_or_create(title=row[CATEGORY])
-    sub_cat, created = Category.objects.get_or_create(
-        title=row[SUB_CATEGORY],
-        parent=base_cat)
-    product.categories.add(sub_cat)
-    shop_cat, created = Category.objects.get_or_create(title="Shop")
-    product.categories.add(shop_cat)
-    return product
+            export_products(csv_file, options["chunk_size"])
+
+
+def _sku(row):
+    # strip whitespace
+    return row[SKU].replace(" ", "")
+
+
+def _category(categories, title, parent=None):
+    """
+    Returns the category with the given title and parent, creating it
+    if required. Categories are kept in the given dict for the
+    duration of the import so each is only looked up once.
+    """
+    key = (title, parent)
+    if key not in categories:
+        lookup = {"title": title}
+        if parent is not None:
+            lookup["parent"] = parent
+        categories[key], created = Category.objects.get_or_create(**lookup)
+    return categories[key]
+
+
+def _products_from_rows(rows):
+    """
+    Returns a dict of titles mapped to products for the given rows,
+    loading existing products in a single query and creating the rest.
+    """
+    products = {}
+    titles = set([row[TITLE] for row in rows])
+    for product in Product.objects.filter(title__in=titles):
+        products.setdefault(product.title, product)
+    for row in rows:
+        product = products.setdefault(row[TITLE], Product(title=row[TITLE]))
+        product.content = row[CONTENT]
+        product.description = row[DESCRIPTION]
+        # TODO: set the 2 below from spreadsheet.
+        product.status = CONTENT_STATUS_PUBLISHED
+        product.available = True
+    for product in products.values():
+        if product.id is None:
+            product.save()
+    return products
 
 
 def _make_image(image_str, product):
@@ -131,95 +195,501 @@ def _make_image(image_str, product):
 def _make_date(date_str, time_str):
     date_string = '%s %s' % (date_str, time_str)
     date = datetime.datetime.strptime(date_string, DATETIME_FORMAT)
+    if getattr(settings, "USE_TZ", False):
+        date = make_aware(date)
     return date
 
 
-def import_products(csv_file):
+def _local_date(date):
+    """
+    Converts a stored date to the current time zone for exporting, the
+    reverse of ``_make_date``. Time zones are only supported from
+    Django 1.4, otherwise stored dates are already local.
+    """
+    if date is not None and getattr(settings, "USE_TZ", False):
+        from django.utils.timezone import localtime
+        date = localtime(date)
+    return date
+
+
+def _variation_fields(row):
+    """
+    Returns the variation field values given in the row, with empty
+    columns as ``None``, so they can be compared against an existing
+    variation when syncing.
+    """
+    fields = {"num_in_stock": None, "unit_price": None, "sale_price": None,
+              "sale_from": None, "sale_to": None}
+    if row[NUM_IN_STOCK]:
+        fields["num_in_stock"] = int(row[NUM_IN_STOCK])
+    if row[UNIT_PRICE]:
+        fields["unit_price"] = Decimal(row[UNIT_PRICE])
+    if row[SALE_PRICE]:
+        fields["sale_price"] = Decimal(row[SALE_PRICE])
+    if row[SALE_START_DATE] and row[SALE_START_TIME]:
+        fields["sale_from"] = _make_date(row[SALE_START_DATE],
+                                         row[SALE_START_TIME])
+    if row[SALE_END_DATE] and row[SALE_END_TIME]:
+        fields["sale_to"] = _make_date(row[SALE_END_DATE],
+                                       row[SALE_END_TIME])
+    for option in TYPE_CHOICES:
+        name = "option%s" % TYPE_CHOICES[option]
+        fields[name] = row[option].decode("utf-8") or None
+    return fields
+
+
+def _add_options(fields, options, new_options):
+    """
+    Adds any option values in the variation fields that aren't yet in
+    ``options`` to ``new_options`` for bulk creation. ``options`` is
+    ``None`` when the options have already been created.
+    """
+    if options is None:
+        return
+    for option in TYPE_CHOICES.values():
+        name = fields["option%s" % option]
+        if name is not None and (option, name) not in options:
+            options.add((option, name))
+            new_options.append(ProductOption(type=option, name=name))
+
+
+def _variation_from_row(row, product, options, new_options):
+    """
+    Builds an unsaved variation for the row, adding any of its options
+    not yet in ``options`` to ``new_options`` for bulk creation.
+    """
+    fields = _variation_fields(row)
+    _add_options(fields, options, new_options)
+    variation = ProductVariation(sku=_sku(row), product=product, **fields)
+    variation.update_effective_price()
+    return variation
+
+
+def _sync_variations(rows, existing, options, new_options):
+    """
+    Updates the existing variations for the given rows, only writing
+    the fields that have changed. Variations with identical changes,
+    such as the same new stock level, are updated in a single query.
+    Returns the IDs of products with changed variations, and the IDs
+    of products whose default variation changed.
+    """
+    changes = {}
+    changed_products = set()
+    changed_defaults = set()
+    for row in rows:
+        variation = existing[_sku(row)]
+        fields = _variation_fields(row)
+        _add_options(fields, options, new_options)
+        changed = []
+        for name, value in fields.items():
+            if getattr(variation, name) != value:
+                changed.append((name, value))
+        if changed:
+            key = tuple(sorted(changed))
+            changes.setdefault(key, []).append(variation.id)
+            changed_products.add(variation.product_id)
+            if variation.default:
+                changed_defaults.add(variation.product_id)
+    priced = set([field.name for field in Priced._meta.fields])
+    repriced = []
+    for changed, ids in changes.items():
+        ProductVariation.objects.filter(id__in=ids).update(**dict(changed))
+        if priced.intersection([name for name, value in changed]):
+            repriced.extend(ids)
+    for i in range(0, len(repriced), BULK_BATCH_SIZE):
+        ProductVariation.update_effective_prices(
+            repriced[i:i + BULK_BATCH_SIZE])
+    return changed_products, changed_defaults
+
+
+def _manage_variations(products):
+    """
+    Bulk equivalent of calling ``variations.manage_empty()`` and
+    ``copy_default_variation()`` for each of the given products.
+    """
+    product_ids = [product.id for product in products]
+    variations = ProductVariation.objects.filter(product__in=product_ids)
+    # Remove redundant empty variations.
+    counts = variations.values_list("product").annotate(total=Count("id"))
+    multiple = [product_id for product_id, total in counts if total > 1]
+    if multiple:
+        empty = {}
+        for field in ProductVariation.option_fields():
+            empty["%s__isnull" % field.name] = True
+        variations.filter(product__in=multiple, **empty).delete()
+    # Ensure each product has a default variation.
+    defaults = variations.filter(default=True).values_list("product")
+    first = {}
+    without_default = variations.exclude(product__in=defaults)
+    for product_id, id in without_default.values_list("product", "id"):
+        first[product_id] = min(id, first.get(product_id, id))
+    if first:
+        ProductVariation.objects.filter(id__in=first.values()).update(
+            default=True)
+    # Copy the default variation's fields onto each product.
+    by_id = dict(zip(product_ids, products))
+    for default in variations.filter(default=True).select_related("image"):
+        product = by_id[default.product_id]
+        for field in Priced._meta.fields:
+            if not isinstance(field, models.AutoField):
+                setattr(product, field.name, getattr(default, field.name))
+        if default.image:
+            product.image = default.image.file.name
+    for product in products:
+        product.save()
+
+
+def _create_rows(rows, categories, options, new_options):
+    """
+    Creates the variations for rows with new SKUs, along with their
+    products and categories. Returns the products for the rows.
+    """
+    products = _products_from_rows(rows)
+    product_ids = [product.id for product in products.values()]
+
+    # Assign categories, only creating the relationships missing.
+    through = Product.categories.through
+    assigned = set(through.objects.filter(product__in=product_ids)
+                   .values_list("product", "category"))
+    new_assigned = []
+    shop_cat = _category(categories, "Shop")
+    for row in rows:
+        product = products[row[TITLE]]
+        # TODO: allow arbitrary level/number of categories.
+        base_cat = _category(categories, row[CATEGORY])
+        sub_cat = _category(categories, row[SUB_CATEGORY], base_cat)
+        for category in (sub_cat, shop_cat):
+            if (product.id, category.id) not in assigned:
+                assigned.add((product.id, category.id))
+                new_assigned.append(through(product_id=product.id,
+                                            category_id=category.id))
+    through.objects.bulk_create(new_assigned)
+
+    # Create variations.
+    variations = []
+    images = {}
+    for row in rows:
+        product = products[row[TITLE]]
+        variation = _variation_from_row(row, product, options, new_options)
+        image_key = (row[IMAGE], product.id)
+        if image_key not in images:
+            images[image_key] = _make_image(row[IMAGE], product)
+        variation.image = images[image_key]
+        if variation.sku:
+            variations.append(variation)
+        else:
+            # Saving a variation without a SKU assigns its ID as the
+            # SKU, so these can't be created in bulk.
+            variation.save()
+    ProductVariation.objects.bulk_create(variations)
+    return products.values()
+
+
+@transaction.commit_on_success
+def _import_rows(rows, categories, options, sync=False, reconcile=True):
+    """
+    Imports a chunk of rows in a single transaction, resolving
+    products, categories and options with as few queries as possible
+    and creating variations in bulk. When syncing, rows for existing
+    SKUs update those variations rather than raising an error, and
+    the category index is refreshed for the products changed.
+
+    ``options`` is the set of existing options, or ``None`` if the
+    options for the rows have already been created. If ``reconcile``
+    is ``False``, reconciling the variations of the products imported
+    is left to the caller.
+    """
+    # Ensure no SKUs are repeated, within the chunk or the database.
+    skus = set()
+    for row in rows:
+        sku = _sku(row)
+        if sku in skus:
+            raise CommandError("Product with SKU exists! sku: %s" % row[SKU])
+        if sku:
+            skus.add(sku)
+    existing = {}
+    if not sync:
+        existing = ProductVariation.objects.filter(sku__in=skus)
+        existing = list(existing.values_list("sku", flat=True)[:1])
+        if existing:
+            raise CommandError("Product with SKU exists! sku: %s" %
+                               existing[0])
+    elif skus:
+        for variation in ProductVariation.objects.filter(sku__in=skus):
+            existing[variation.sku] = variation
+
+    new_options = []
+    changed, changed_defaults = set(), set()
+    if existing:
+        synced = [row for row in rows if _sku(row) in existing]
+        rows = [row for row in rows if _sku(row) not in existing]
+        changed, changed_defaults = _sync_variations(synced, existing,
+                                                     options, new_options)
+    products = []
+    if rows:
+        products = _create_rows(rows, categories, options, new_options)
+    ProductOption.objects.bulk_create(new_options)
+
+    if not reconcile:
+        return
+    product_ids = set([product.id for product in products])
+    changed_defaults -= product_ids
+    if changed_defaults:
+        products += list(Product.objects.filter(id__in=changed_defaults))
+    _manage_variations(products)
+    if sync:
+        product_ids |= changed
+        if product_ids:
+            CategoryProduct.objects.refresh(products=list(product_ids))
+
+
+@transaction.commit_on_success
+def _prepare_rows(rows, categories, options):
+    """
+    Creates the categories and options for the rows ahead of handing
+    them to a worker process, since ``get_or_create`` isn't safe to
+    run concurrently.
+    """
+    new_options = []
+    for row in rows:
+        _category(categories, row[SUB_CATEGORY],
+                  _category(categories, row[CATEGORY]))
+        _add_options(_variation_fields(row), options, new_options)
+    _category(categories, "Shop")
+    ProductOption.objects.bulk_create(new_options)
+
+
+def _import_worker(queue, sync):
+    """
+    Imports each chunk of rows put onto the queue until ``None`` is
+    received. Options have already been created by the main process,
+    and reconciling variations is left to it once all workers finish.
+    """
+    # Close the connection for this process to avoid the issue discussed here:
+    # http://groups.google.com/group/django-users/
+    # browse_thread/thread/2c7421cdb9b99e48
+    connection.close()
+    categories = {}
+    total = 0
+    start = time()
+    while True:
+        rows = queue.get()
+        if rows is None:
+            break
+        _import_rows(rows, categories, None, sync, reconcile=False)
+        total += len(rows)
+        rate = total / max(time() - start, 0.001)
+        print _("Worker %s imported %s rows (%.1f rows/sec)") % (
+            os.getpid(), total, rate)
+
+
+def _put(queue, process, rows):
+    """
+    Puts the rows onto the worker's queue, waiting while it's full,
+    unless the worker has stopped.
+    """
+    while True:
+        try:
+            queue.put(rows, timeout=1)
+        except Full:
+            if not process.is_alive():
+                raise CommandError(_("Import failed in worker process"))
+        else:
+            break
+
+
+def _import_parallel(reader, chunk_size, sync, workers):
+    """
+    Shards the rows by product title across worker processes, so
+    that all rows for a product are imported by the same worker, then
+    reconciles the variations for the imported products.
+    """
+    categories = {}
+    options = set(ProductOption.objects.values_list("type", "name"))
+    queues = [Queue(maxsize=IMPORT_QUEUE_SIZE) for i in range(workers)]
+    processes = [Process(target=_import_worker, args=(queue, sync))
+                 for queue in queues]
+    connection.close()
+    for process in processes:
+        process.start()
+    shards = [[] for queue in queues]
+    titles = set()
+    try:
+        for row in reader:
+            titles.add(row[TITLE])
+            shard = hash(row[TITLE]) % workers
+            shards[shard].append(row)
+            if len(shards[shard]) == chunk_size:
+                _prepare_rows(shards[shard], categories, options)
+                _put(queues[shard], processes[shard], shards[shard])
+                shards[shard] = []
+        for shard, rows in enumerate(shards):
+            if rows:
+                _prepare_rows(rows, categories, options)
+                _put(queues[shard], processes[shard], rows)
+            _put(queues[shard], processes[shard], None)
+    except:
+        # Workers would otherwise wait on their queues indefinitely.
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+    failed = len([p for p in processes if p.exitcode != 0])
+    if failed:
+        raise CommandError(_("Import failed in %s worker processes") % failed)
+
+    print _("Reconciling variations ..")
+    titles = list(titles)
+    for i in range(0, len(titles), BULK_BATCH_SIZE):
+        products = Product.objects.filter(
+            title__in=titles[i:i + BULK_BATCH_SIZE])
+        _reconcile_products(list(products), sync)
+
+
+@transaction.commit_on_success
+def _reconcile_products(products, sync):
+    """
+    Removes redundant empty variations and copies default variations
+    onto the given products, refreshing their category index entries
+    when syncing.
+    """
+    _manage_variations(products)
+    if sync and products:
+        product_ids = [product.id for product in products]
+        CategoryProduct.objects.refresh(products=product_ids)
+
+
+def import_products(csv_file, chunk_size=IMPORT_CHUNK_SIZE, sync=False,
+                    workers=1):
+    """
+    Imports products from the csv file in chunks. If ``sync`` is
+    ``True``, rows with SKUs that already exist update the stock,
+    prices, sale dates and options of those variations where they
+    differ, rather than raising an error. If ``workers`` is greater
+    than one, chunks are imported in parallel by that many processes.
+    """
     print _("Importing ..")
     # More appropriate for testing.
     #Product.objects.all().delete()
-    reader = csv.DictReader(open(csv_file), delimiter=',')
-    for row in reader:
-        print row
-        product = _product_from_row(row)
-        try:
-            variation = ProductVariation.objects.create(
-                # strip whitespace
-                sku=row[SKU].replace(" ", ""),
-                product=product,
-            )
-        except IntegrityError:
-            raise CommandError("Product with SKU exists! sku: %s" % row[SKU])
-        if row[NUM_IN_STOCK]:
-            variation.num_in_stock = row[NUM_IN_STOCK]
-        if row[UNIT_PRICE]:
-            variation.unit_price = row[UNIT_PRICE]
-        if row[SALE_PRICE]:
-            variation.sale_price = row[SALE_PRICE]
-        if row[SALE_START_DATE] and row[SALE_START_TIME]:
-            variation.sale_from = _make_date(row[SALE_START_DATE],
-                                                row[SALE_START_TIME])
-        if row[SALE_END_DATE] and row[SALE_END_TIME]:
-            variation.sale_to = _make_date(row[SALE_END_DATE],
-                                                row[SALE_END_TIME])
-        for option in TYPE_CHOICES:
-            if row[option]:
-                name = "option%s" % TYPE_CHOICES[option]
-                setattr(variation, name, row[option])
-                new_option, created = ProductOption.objects.get_or_create(
-                    type=TYPE_CHOICES[option],  # TODO: set dynamically
-                    name=row[option])
-        variation.save()
-        image = _make_image(row[IMAGE], product)
-        if image:
-            variation.image = image
-        product.variations.manage_empty()
-        product.copy_default_variation()
-        product.save()
+    reader = csv.DictReader(_open(csv_file, 'r'), delimiter=',')
+    # The category index is refreshed once per chunk when syncing, or
+    # rebuilt once at the end otherwise, rather than as each product
+    # is saved.
+    CategoryProduct.objects.auto_refresh = False
+    try:
+        if workers > 1:
+            _import_parallel(reader, chunk_size, sync, workers)
+        else:
+            categories = {}
+            options = set(ProductOption.objects.values_list("type", "name"))
+            total = 0
+            start = time()
+            while True:
+                rows = list(islice(reader, chunk_size))
+                if not rows:
+                    break
+                _import_rows(rows, categories, options, sync)
+                total += len(rows)
+                rate = total / max(time() - start, 0.001)
+                print _("Imported %s rows (%.1f rows/sec)") % (total, rate)
+    finally:
+        CategoryProduct.objects.auto_refresh = True
+    if not sync:
+        CategoryProduct.objects.refresh()
+    CategoryProduct.objects.update_sales(force=True)
+    # Variations are written with bulk queries rather than being saved.
+    Product.objects.clear_cached()
 
     print "Variations: %s" % ProductVariation.objects.all().count()
     print "Products: %s" % Product.objects.all().count()
 
 
-def export_products(csv_file):
-    print _("Exporting ..")
-    filehandle = open(csv_file, 'w')
+def _open(csv_file, mode):
+    """
+    Opens the csv file, with ``-`` meaning stdin or stdout, and files
+    ending in ``.gz`` being gzip compressed.
+    """
+    if csv_file == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    if csv_file.endswith(".gz"):
+        return gzip.open(csv_file, mode + "b")
+    return open(csv_file, mode)
+
+
+def _category_titles(product_ids):
+    """
+    Returns a dict of product IDs mapped to the category and
+    sub-category titles to export for each of the given products,
+    using the first of each product's categories.
+    """
+    through = Product.categories.through
+    assigned = through.objects.filter(product__in=product_ids)
+    assigned = assigned.order_by("category__titles").values_list(
+        "product", "category__title", "category__parent__title")
+    titles = {}
+    for product_id, title, parent_title in assigned:
+        if product_id not in titles:
+            if parent_title:
+                titles[product_id] = (parent_title, title)
+            else:
+                titles[product_id] = (title, "")
+    return titles
+
+
+def export_products(csv_file, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Exports each variation to the csv file, reading variations in
+    chunks with their products, images and categories loaded in bulk
+    so that memory use doesn't grow with the size of the catalog.
+    """
+    if csv_file != "-":
+        print _("Exporting ..")
+    filehandle = _open(csv_file, 'w')
     writer = csv.DictWriter(filehandle, delimiter=',', fieldnames=fieldnames)
     headers = dict()
     for field in fieldnames:
         headers[field] = field
     writer.writerow(headers)
-    for pv in ProductVariation.objects.all():
-        row = dict()
-        row[TITLE] = pv.product.title
-        row[CONTENT] = pv.product.content
-        row[DESCRIPTION] = pv.product.description
-        row[SKU] = pv.sku
-        row[IMAGE] = pv.image
-        # TODO: handle multiple categories, and multiple levels of categories
-        cat = pv.product.categories.all()[0]
-        if cat.parent:
-            row[SUB_CATEGORY] = cat.title
-            row[CATEGORY] = cat.parent.title
-        else:
-            row[CATEGORY] = cat.title
-            row[SUB_CATEGORY] = ""
+    variations = ProductVariation.objects.select_related("product", "image")
+    variations = variations.order_by("id")
+    last_id = 0
+    while True:
+        chunk = list(variations.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        categories = _category_titles([pv.product_id for pv in chunk])
+        for pv in chunk:
+            row = dict()
+            row[TITLE] = pv.product.title
+            row[CONTENT] = pv.product.content
+            row[DESCRIPTION] = pv.product.description
+            row[SKU] = pv.sku
+            row[IMAGE] = pv.image
+            # TODO: handle multiple categories, and multiple levels of
+            # categories
+            row[CATEGORY], row[SUB_CATEGORY] = categories.get(
+                pv.product_id, ("", ""))
 
-        for option in TYPE_CHOICES:
-            row[option] = getattr(pv, "option%s" % TYPE_CHOICES[option])
+            for option in TYPE_CHOICES:
+                row[option] = getattr(pv, "option%s" % TYPE_CHOICES[option])
 
-        row[NUM_IN_STOCK] = pv.num_in_stock
-        row[UNIT_PRICE] = pv.unit_price
-        row[SALE_PRICE] = pv.sale_price
-        try:
-            row[SALE_START_DATE] = pv.sale_from.strftime(DATE_FORMAT)
-            row[SALE_START_TIME] = pv.sale_from.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        try:
-            row[SALE_END_DATE] = pv.sale_to.strftime(DATE_FORMAT)
-            row[SALE_END_TIME] = pv.sale_to.strftime(TIME_FORMAT)
-        except AttributeError:
-            pass
-        writer.writerow(row)
-    filehandle.close()
+            row[NUM_IN_STOCK] = pv.num_in_stock
+            row[UNIT_PRICE] = pv.unit_price
+            row[SALE_PRICE] = pv.sale_price
+            sale_from = _local_date(pv.sale_from)
+            sale_to = _local_date(pv.sale_to)
+            try:
+                row[SALE_START_DATE] = sale_from.strftime(DATE_FORMAT)
+                row[SALE_START_TIME] = sale_from.strftime(TIME_FORMAT)
+            except AttributeError:
+                pass
+            try:
+                row[SALE_END_DATE] = sale_to.strftime(DATE_FORMAT)
+                row[SALE_END_TIME] = sale_to.strftime(TIME_FORMAT)
+            except AttributeError:
+                pass
+            writer.writerow(row)
+    if filehandle is not sys.stdout:
+        filehandle.close()
@@ -0,0 +1,18 @@
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import CategoryProduct
+
+
+class Command(NoArgsCommand):
+    help = _("Rebuilds the stored products for every category from the "
+             "category's filters. Required when first installing the "
+             "category index, or after bulk changes to products that "
+             "were made without saving each product.")
+
+    def handle_noargs(self, **options):
+        CategoryProduct.objects.refresh()
+        if int(options.get("verbosity", 1)) >= 1:
+            total = CategoryProduct.objects.count()
+            print _("Category index rebuilt with %s entries") % total
@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import ProductVariation
+
+
+class Command(NoArgsCommand):
+    help = _("Rebuilds the quantity of each variation held in carts from "
+             "the cart items. Required when first adding the stored "
+             "quantity, or if it drifts from the cart items, such as "
+             "after cart items are changed directly in the database.")
+
+    def handle_noargs(self, **options):
+        total = ProductVariation.objects.rebuild_num_in_carts()
+        if int(options.get("verbosity", 1)) >= 1:
+            print _("Quantity in carts corrected for %s variations") % total
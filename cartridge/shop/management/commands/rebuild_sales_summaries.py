@@ -0,0 +1,45 @@
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.managers import BULK_BATCH_SIZE
+from cartridge.shop.models import SalesSummary
+
+
+class Command(NoArgsCommand):
+    help = _("Rebuilds the daily sales summaries from existing orders, "
+             "for all dates or the dates given. Required when first "
+             "adding the summaries, or after orders are changed "
+             "directly in the database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--start",
+            dest="start",
+            help=_("First date to rebuild, as YYYY-MM-DD.")),
+        make_option("--end",
+            dest="end",
+            help=_("Last date to rebuild, as YYYY-MM-DD.")),
+        make_option("--chunk-size",
+            dest="chunk_size",
+            type="int",
+            default=BULK_BATCH_SIZE,
+            help=_("Number of orders read per query.")),
+    )
+
+    def handle_noargs(self, **options):
+        dates = []
+        for option in ("start", "end"):
+            value = options.get(option)
+            if value:
+                try:
+                    value = datetime.strptime(value, "%Y-%m-%d").date()
+                except ValueError:
+                    raise CommandError(_("Invalid date: %s") % value)
+            dates.append(value or None)
+        total = SalesSummary.objects.rebuild(*dates,
+                                             chunk_size=options["chunk_size"])
+        if int(options.get("verbosity", 1)) >= 1:
+            print _("Sales summaries rebuilt from %s orders") % total
@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.models import ProductAction
+
+
+class Command(NoArgsCommand):
+    help = _("Adds the days of product actions since the last run to "
+             "the popularity score of each product, decaying the "
+             "existing scores. Should be run daily.")
+
+    def handle_noargs(self, **options):
+        total = ProductAction.objects.update_popularity()
+        if int(options.get("verbosity", 1)) >= 1:
+            print _("Popularity increased for %s products") % total
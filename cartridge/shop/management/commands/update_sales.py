@@ -0,0 +1,50 @@
+
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from mezzanine.utils.timezone import now
+
+from cartridge.shop.models import CategoryProduct
+
+
+class Command(NoArgsCommand):
+    help = _("Refreshes the categories filtering by sale or price for "
+             "products whose sales have started or ended since the "
+             "last run, or for all products with sale prices if the "
+             "time of the last run has expired from the cache. Can be "
+             "run periodically, or continuously with the --wait "
+             "option.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--wait",
+            action="store_true",
+            dest="wait",
+            default=False,
+            help=_("Keep running, sleeping until each sale boundary.")),
+        make_option("--max-sleep",
+            dest="max_sleep",
+            type="int",
+            default=60,
+            help=_("Maximum seconds to sleep between checks when "
+                   "waiting, so that sales saved elsewhere are picked "
+                   "up.")),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        while True:
+            boundary = CategoryProduct.objects.update_sales(force=True,
+                                                          rebuild=True)
+            if verbosity >= 1:
+                print _("Next sale boundary: %s") % boundary
+            if not options["wait"]:
+                break
+            seconds = options["max_sleep"]
+            if boundary is not None:
+                delta = boundary - now()
+                delta = delta.days * 86400 + delta.seconds + 1
+                seconds = max(0, min(seconds, delta))
+            sleep(seconds)
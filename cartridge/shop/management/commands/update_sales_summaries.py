@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from cartridge.shop.managers import BULK_BATCH_SIZE
+from cartridge.shop.models import SalesSummary
+
+
+class Command(NoArgsCommand):
+    help = _("Adds the orders completed since the last run to the daily "
+             "sales summaries. Should be run periodically, such as from "
+             "cron.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--chunk-size",
+            dest="chunk_size",
+            type="int",
+            default=BULK_BATCH_SIZE,
+            help=_("Number of orders read per query.")),
+    )
+
+    def handle_noargs(self, **options):
+        total = SalesSummary.objects.add_pending(options["chunk_size"])
+        if int(options.get("verbosity", 1)) >= 1:
+            print _("Added %s orders to the sales summaries") % total
@@ -1,36 +1,145 @@
 
+from __future__ import with_statement
+
 from collections import defaultdict
 from datetime import datetime, timedelta
+from hashlib import md5
+from threading import Lock
+from time import time
 
-from django.db.models import Manager, Q
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Manager, Max, Min, Q, Sum
 from django.utils.datastructures import SortedDict
 
 from mezzanine.conf import settings
-from mezzanine.utils.timezone import now
+from mezzanine.core.managers import DisplayableManager
+from mezzanine.utils.sites import current_site_id
+from mezzanine.utils.timezone import make_aware, now
+
+
+# Number of rows written or deleted per query when performing bulk
+# operations, which keeps the number of query parameters under the
+# limits imposed by some database backends such as SQLite.
+BULK_BATCH_SIZE = 500
+
+# Cache key and expiry for the state of sale boundaries, used by
+# ``CategoryProductManager.update_sales``. When the state expires, all
+# categories filtering by sale or price are refreshed on the next call.
+SALE_BOUNDARIES_CACHE_KEY = "cartridge.shop.sale_boundaries"
+SALE_BOUNDARIES_CACHE_SECONDS = 60 * 60 * 24
+
+# Cache keys for the details shown on product pages, stored by
+# ``ProductManager.details``. The keys for details include a version,
+# which is changed to remove all of them at once when prices are
+# changed with queryset updates, such as when a sale is applied.
+PRODUCT_CACHE_KEY = "cartridge.shop.product.%s.%s"
+PRODUCT_SLUG_CACHE_KEY = "cartridge.shop.product_slug.%s.%s"
+PRODUCT_CACHE_VERSION_KEY = "cartridge.shop.product_version"
+
+# Cache key for the version included in the cache keys for the number
+# of products in each category, cached by the category page when
+# ``SHOP_CATEGORY_KEYSET_PAGING`` is used. Changed by
+# ``CategoryProductManager.clear_counts`` to remove all of them at once
+# when products are saved or the categories' products change.
+CATEGORY_COUNT_VERSION_KEY = "cartridge.shop.category_count_version"
+
+# Counts for ``ProductAction`` fields buffered in this process by
+# ``ProductActionManager.increment``, keyed by product ID, timestamp
+# and field name, along with the time they were last written.
+_action_buffer = defaultdict(int)
+_action_buffer_lock = Lock()
+_action_buffer_flushed = [time()]
+
+# Weight of each ``ProductAction`` field in a product's popularity
+# score, the field storing how much of it has been added to the score,
+# and the score below which it's reset to zero as it decays.
+POPULARITY_WEIGHTS = {"total_cart": 1, "total_purchase": 5}
+POPULARITY_COUNTED_FIELDS = {"total_cart": "counted_cart",
+                             "total_purchase": "counted_purchase"}
+POPULARITY_MIN = 0.001
 
 
 class CartManager(Manager):
 
     def from_request(self, request):
         """
-        Return a cart by ID stored in the session, creating it if not
-        found as well as removing old carts prior to creating a new
-        cart.
+        Return a cart by ID stored in the session. If not found, an
+        unsaved cart is returned which is only stored when an item is
+        first added to it, so that requests which don't add to the
+        cart don't write to the database. If
+        ``SHOP_CART_SESSION_STORAGE`` is ``True``, anonymous users are
+        given a ``SessionCart`` that isn't stored until checkout.
+        Expired carts are removed separately by ``delete_expired``.
         """
         n = now()
-        expiry_minutes = timedelta(minutes=settings.SHOP_CART_EXPIRY_MINUTES)
-        expiry_time = n - expiry_minutes
-        try:
-            cart_id = request.session.get("cart", None)
-            cart = self.get(last_updated__gte=expiry_time, id=cart_id)
-        except self.model.DoesNotExist:
-            self.filter(last_updated__lt=expiry_time).delete()
-            cart = self.create(last_updated=n)
-            request.session["cart"] = cart.id
+        expiry_time = self.expiry_time()
+        cart_id = request.session.get("cart", None)
+        if cart_id is not None:
+            try:
+                cart = self.get(last_updated__gte=expiry_time, id=cart_id)
+            except self.model.DoesNotExist:
+                del request.session["cart"]
+            else:
+                # Update timestamp, only once it's behind by more than
+                # SHOP_CART_TOUCH_FRACTION of the expiry time.
+                touch_minutes = (settings.SHOP_CART_EXPIRY_MINUTES *
+                                 settings.SHOP_CART_TOUCH_FRACTION)
+                if cart.last_updated < n - timedelta(minutes=touch_minutes):
+                    cart.last_updated = n
+                    self.filter(id=cart.id).update(last_updated=n)
+                return cart
+        user = getattr(request, "user", None)
+        anonymous = user is None or not user.is_authenticated()
+        session_storage = settings.SHOP_CART_SESSION_STORAGE and anonymous
+        if session_storage or request.session.get("cart_items"):
+            from cartridge.shop.models import SessionCart
+            cart = SessionCart(last_updated=n)
         else:
-            cart.save()  # Update timestamp.
+            cart = self.model(last_updated=n)
+        # Used by ``Cart.add_item`` to store the cart's ID once saved,
+        # and by ``SessionCart`` for its items.
+        cart._session = request.session
+        if not session_storage:
+            # Store any items kept in the session before logging in.
+            cart = cart.store()
         return cart
 
+    def expiry_time(self):
+        """
+        Returns the time that carts last updated before have expired.
+        Since ``last_updated`` is only saved once it's behind by
+        ``SHOP_CART_TOUCH_FRACTION`` of ``SHOP_CART_EXPIRY_MINUTES``,
+        carts are kept for that much longer so that they're never
+        expired before the expiry minutes have passed since last used.
+        """
+        expiry_minutes = (settings.SHOP_CART_EXPIRY_MINUTES *
+                          (1 + settings.SHOP_CART_TOUCH_FRACTION))
+        return now() - timedelta(minutes=expiry_minutes)
+
+    def delete_expired(self, batch_size=BULK_BATCH_SIZE):
+        """
+        Delete expired carts and their items, a batch of carts at a
+        time with each batch in its own transaction, so that tables
+        aren't locked for long. Returns the number of carts deleted.
+        """
+        expired = self.filter(last_updated__lt=self.expiry_time())
+        total = 0
+        while True:
+            ids = list(expired.values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+            self._delete_batch(ids)
+            total += len(ids)
+        return total
+
+    @transaction.commit_on_success
+    def _delete_batch(self, ids):
+        """
+        Delete the carts with the given IDs in a single transaction.
+        """
+        self.filter(id__in=ids).delete()
+
 
 class OrderManager(Manager):
 
@@ -46,6 +155,137 @@ class OrderManager(Manager):
         raise self.model.DoesNotExist
 
 
+class ProductManager(DisplayableManager):
+
+    def details(self, slug, for_user=None):
+        """
+        Returns a dict of the published product with the given slug,
+        its variations, images, related products, the values of each
+        option for its priced variations, and the fields of each
+        variation for the product page's JSON. For users who aren't
+        staff, the dict is cached per product until the product, its
+        variations or images are changed, or a sale is applied, so
+        that the catalog isn't queried each time the product is shown.
+        Only the stock levels and prices of the variations are
+        retrieved when cached, as stock changes too often to cache and
+        prices are charged from them. Raises
+        ``DoesNotExist`` if the product isn't published.
+        """
+        staff = for_user is not None and for_user.is_staff
+        timeout = settings.SHOP_PRODUCT_CACHE_SECONDS
+        use_cache = timeout and not staff
+        details = None
+        if use_cache:
+            slug_hash = md5(slug.encode("utf-8")).hexdigest()
+            site_id = current_site_id()
+            slug_key = PRODUCT_SLUG_CACHE_KEY % (site_id, slug_hash)
+            product_id = cache.get(slug_key)
+            if product_id is not None:
+                details = cache.get(self._cache_key(product_id))
+            # The slug may have been changed, leaving the old slug
+            # pointing at the product.
+            if details is not None and details["product"].slug != slug:
+                details = None
+        if details is None:
+            product = self.published(for_user=for_user).get(slug=slug)
+            details = self._details(product)
+            if use_cache:
+                cache.set(slug_key, product.id, timeout)
+                cache.set(self._cache_key(product.id), details, timeout)
+        elif not self._is_published(details["product"]):
+            raise self.model.DoesNotExist
+        else:
+            self._refresh_variations(details["variations"])
+        if not staff:
+            related = filter(self._is_published, details["related"])
+            details = dict(details, related=related)
+        return details
+
+    def clear_cached(self, product_ids=None):
+        """
+        Removes the cached details for the products with the given
+        IDs, or for all products if no IDs are given.
+        """
+        if not settings.SHOP_PRODUCT_CACHE_SECONDS:
+            return
+        if product_ids is None:
+            cache.set(PRODUCT_CACHE_VERSION_KEY, str(time()),
+                      settings.SHOP_PRODUCT_CACHE_SECONDS)
+        else:
+            version = self._cache_version()
+            cache.delete_many([PRODUCT_CACHE_KEY % (version, product_id)
+                               for product_id in product_ids])
+
+    def _cache_version(self):
+        """
+        Returns the version included in the cache keys for details,
+        setting a new one if it has expired.
+        """
+        version = cache.get(PRODUCT_CACHE_VERSION_KEY)
+        if version is None:
+            version = str(time())
+            cache.set(PRODUCT_CACHE_VERSION_KEY, version,
+                      settings.SHOP_PRODUCT_CACHE_SECONDS)
+        return version
+
+    def _cache_key(self, product_id):
+        return PRODUCT_CACHE_KEY % (self._cache_version(), product_id)
+
+    def _refresh_variations(self, variations):
+        """
+        Sets the current stock levels and prices on the given cached
+        variations, since the cache may not be shared between
+        processes, so that a price changed in another process is
+        never added to the cart.
+        """
+        from cartridge.shop.models import Priced, ProductVariation
+        fields = ["num_in_stock", "num_in_carts"]
+        fields += [f.attname for f in Priced._meta.fields]
+        variations = dict([(v.id, v) for v in variations])
+        current = ProductVariation.objects.filter(id__in=variations.keys())
+        for values in current.values_list("id", *fields):
+            for field, value in zip(fields, values[1:]):
+                setattr(variations[values[0]], field, value)
+
+    def _details(self, product):
+        """
+        Retrieves the details for the product returned by ``details``.
+        """
+        from cartridge.shop.models import ProductVariation
+        json_fields = [f.name for f in ProductVariation.option_fields()]
+        json_fields += ["sku", "image_id"]
+        variations = list(product.variations.all())
+        images = list(product.images.all())
+        images_by_id = dict([(image.id, image) for image in images])
+        # Assign the product and image to each variation, as they're
+        # used when the variation is added to the cart.
+        for variation in variations:
+            variation.product = product
+            if variation.image_id in images_by_id:
+                variation.image = images_by_id[variation.image_id]
+        variations_json = [dict([(f, getattr(v, f)) for f in json_fields])
+                           for v in variations]
+        return {
+            "product": product,
+            "variations": variations,
+            "variations_json": variations_json,
+            "images": images,
+            "related": list(product.related_products.all()),
+            "options": ProductVariation.option_values(variations),
+        }
+
+    def _is_published(self, product):
+        """
+        Returns True if the product would be returned by
+        ``published`` for users who aren't staff.
+        """
+        from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+        n = now()
+        return (product.status == CONTENT_STATUS_PUBLISHED and
+                (product.publish_date is None or product.publish_date <= n)
+                and (product.expiry_date is None or product.expiry_date >= n))
+
+
 class ProductOptionManager(Manager):
 
     def as_fields(self):
@@ -112,6 +352,74 @@ class ProductVariationManager(Manager):
             first_variation.default = True
             first_variation.save()
 
+    @transaction.commit_on_success
+    def reduce_stock(self, quantities, clamp=False):
+        """
+        Reduce the stock level for each SKU in the given dict of SKUs
+        and quantities in a single transaction. Each SKU is reduced
+        with a conditional update, so concurrent orders for the same
+        SKU neither lose updates nor take stock below zero. Returns a
+        list of SKUs without enough stock. If there are any, the
+        transaction is rolled back so that no stock is reduced, unless
+        ``clamp`` is ``True``, such as when the items have already
+        been paid for, in which case the other SKUs are reduced and
+        those without enough stock are set to zero. Variations without
+        a stock level are ignored.
+        """
+        failed = []
+        for sku, quantity in quantities.items():
+            variations = self.filter(sku=sku, num_in_stock__gte=quantity)
+            reduced = variations.update(
+                num_in_stock=F("num_in_stock") - quantity)
+            if not reduced:
+                failed.append(sku)
+        if failed:
+            failed = self.filter(sku__in=failed, num_in_stock__isnull=False)
+            failed = list(failed.values_list("sku", flat=True))
+            if clamp and failed:
+                self.filter(sku__in=failed).update(num_in_stock=0)
+            elif failed:
+                transaction.rollback()
+        return failed
+
+    def restore_stock(self, quantities):
+        """
+        Increase the stock level for each SKU in the given dict of
+        SKUs and quantities, reversing ``reduce_stock``.
+        """
+        for sku, quantity in quantities.items():
+            variations = self.filter(sku=sku, num_in_stock__isnull=False)
+            variations.update(num_in_stock=F("num_in_stock") + quantity)
+
+    def reserve(self, sku, quantity):
+        """
+        Adjust the quantity of the SKU held in carts by the given
+        amount, which is negative when the quantity is released.
+        """
+        variations = self.filter(sku=sku)
+        variations.update(num_in_carts=F("num_in_carts") + quantity)
+
+    def rebuild_num_in_carts(self):
+        """
+        Rebuild ``num_in_carts`` for every variation from the items
+        in carts, correcting any drift. Returns the number of
+        variations that were changed.
+        """
+        from cartridge.shop.models import CartItem
+        items = CartItem.objects.values_list("sku")
+        totals = dict(items.annotate(quantity=Sum("quantity")))
+        changed = defaultdict(list)
+        variations = self.values_list("id", "sku", "num_in_carts")
+        for id, sku, num_in_carts in variations:
+            total = totals.get(sku) or 0
+            if num_in_carts != total:
+                changed[total].append(id)
+        for total, ids in changed.items():
+            for i in range(0, len(ids), BULK_BATCH_SIZE):
+                batch = ids[i:i + BULK_BATCH_SIZE]
+                self.filter(id__in=batch).update(num_in_carts=total)
+        return sum([len(ids) for ids in changed.values()])
+
     def set_default_images(self, deleted_image_ids):
         """
         Assign the first image for the product to each variation that
@@ -136,20 +444,360 @@ class ProductVariationManager(Manager):
                 variation.save()
 
 
+class CategoryProductManager(Manager):
+
+    # Set to ``False`` to skip refreshing the index as each category,
+    # product or variation is saved, such as when importing products,
+    # in which case ``refresh`` should be called once afterwards.
+    auto_refresh = True
+
+    def refresh(self, categories=None, products=None):
+        """
+        Bring the stored products for each category in line with the
+        category's filters. Categories can be given as instances or
+        IDs and default to all categories. If product IDs are given,
+        only those products are checked, and when no categories are
+        given, only the categories that could contain those products
+        are evaluated. The eligible products for discounts are then
+        refreshed, for the categories whose products changed.
+        """
+        from cartridge.shop.models import Category, DiscountCode, Product
+        from cartridge.shop.models import Sale
+        if categories is not None:
+            ids = [getattr(c, "id", c) for c in categories]
+            categories = Category.objects.filter(id__in=ids)
+        else:
+            categories = Category.objects.all()
+            if products is not None:
+                categories = categories.filter(Q(products__in=products) |
+                    Q(product_index__product__in=products) |
+                    Q(options__isnull=False) | Q(sale__isnull=False) |
+                    Q(price_min__isnull=False) | Q(price_max__isnull=False))
+        changed = []
+        for category in categories.distinct():
+            matched = Product.objects.filter(category.filters())
+            indexed = self.filter(category=category)
+            if products is not None:
+                matched = matched.filter(id__in=products)
+                indexed = indexed.filter(product__in=products)
+            matched = set(matched.values_list("id", flat=True))
+            indexed = set(indexed.values_list("product_id", flat=True))
+            removed = list(indexed - matched)
+            added = [self.model(category=category, product_id=product_id)
+                     for product_id in matched - indexed]
+            for i in range(0, len(removed), BULK_BATCH_SIZE):
+                batch = removed[i:i + BULK_BATCH_SIZE]
+                self.filter(category=category, product__in=batch).delete()
+            for i in range(0, len(added), BULK_BATCH_SIZE):
+                self.bulk_create(added[i:i + BULK_BATCH_SIZE])
+            if removed or added:
+                changed.append(category.id)
+        if changed:
+            self.clear_counts()
+            for model in (Sale, DiscountCode):
+                discounts = model.objects.filter(categories__in=changed)
+                for discount in discounts.distinct():
+                    discount.refresh_products()
+
+    def count_version(self):
+        """
+        Returns the version included in the cache keys for the number
+        of products in each category, setting a new one if it has
+        expired.
+        """
+        version = cache.get(CATEGORY_COUNT_VERSION_KEY)
+        if version is None:
+            version = self.clear_counts()
+        return version
+
+    def clear_counts(self):
+        """
+        Removes the number of products cached for every category, by
+        changing the version in their cache keys. Returns the new
+        version.
+        """
+        version = str(time())
+        cache.set(CATEGORY_COUNT_VERSION_KEY, version)
+        return version
+
+    def _sale_categories(self):
+        """
+        Categories whose filters depend on sale dates.
+        """
+        from cartridge.shop.models import Category
+        return Category.objects.filter(Q(sale__isnull=False) |
+                                       Q(price_min__isnull=False) |
+                                       Q(price_max__isnull=False))
+
+    def next_sale_boundary(self, after):
+        """
+        Returns the earliest sale start or end time across products
+        and variations that occurs after the given time, or ``None``.
+        """
+        from cartridge.shop.models import Product, ProductVariation
+        boundaries = []
+        for model in (Product, ProductVariation):
+            for field in ("sale_from", "sale_to"):
+                lookup = {"%s__gt" % field: after}
+                aggregate = model.objects.filter(**lookup).aggregate(
+                    boundary=Min(field))
+                if aggregate["boundary"] is not None:
+                    boundaries.append(aggregate["boundary"])
+        if boundaries:
+            return min(boundaries)
+        return None
+
+    def update_sales(self, force=False, rebuild=False):
+        """
+        Updates the effective price of products and variations that
+        have had a sale start or end since the last call, refreshes
+        the categories filtering by sale or price for those products,
+        clears the cached product details, and returns the time of
+        the next sale boundary, until which prices and category
+        results are valid. Cheap to call when no boundary has passed,
+        as the state is stored in the cache, unless ``force`` is given
+        which also recalculates the next boundary.
+
+        If the state isn't found, such as after a restart, only the
+        products and variations whose effective price no longer
+        matches their sale dates are updated, since it's called when
+        serving pages. The ``update_sales`` command gives ``rebuild``
+        instead, which updates everything with a sale price and
+        refreshes all of the categories filtering by sale or price.
+        """
+        from cartridge.shop.models import Product, ProductVariation
+        n = now()
+        state = cache.get(SALE_BOUNDARIES_CACHE_KEY)
+        rebuild = rebuild and state is None
+        if state is not None:
+            if not force and (state["next"] is None or state["next"] > n):
+                return state["next"]
+            since = state["checked"]
+            passed = (Q(sale_from__gt=since, sale_from__lte=n) |
+                      Q(sale_to__gte=since, sale_to__lt=n))
+        elif rebuild:
+            passed = Q(sale_price__isnull=False)
+        else:
+            on_sale = ((Q(sale_from__isnull=True) | Q(sale_from__lt=n)) &
+                       (Q(sale_to__isnull=True) | Q(sale_to__gt=n)))
+            passed = Q(sale_price__isnull=False) & (
+                (on_sale & ~Q(effective_price=F("sale_price"))) |
+                (~on_sale & ~Q(effective_price=F("unit_price"))))
+        products = set()
+        for model, product_field in ((Product, "id"),
+                                     (ProductVariation, "product_id")):
+            ids = []
+            priced = model.objects.filter(passed)
+            for id, product_id in priced.values_list("id", product_field):
+                ids.append(id)
+                products.add(product_id)
+            for i in range(0, len(ids), BULK_BATCH_SIZE):
+                model.update_effective_prices(ids[i:i + BULK_BATCH_SIZE])
+        if rebuild:
+            self.refresh(categories=self._sale_categories())
+        elif products:
+            self.refresh(categories=self._sale_categories(),
+                         products=products)
+        if rebuild or products:
+            # Prices are also shown for related products, so clear the
+            # details cached for every product.
+            Product.objects.clear_cached()
+        state = {"checked": n, "next": self.next_sale_boundary(n)}
+        cache.set(SALE_BOUNDARIES_CACHE_KEY, state,
+                  SALE_BOUNDARIES_CACHE_SECONDS)
+        return state["next"]
+
+    def schedule_sale_boundaries(self, *boundaries):
+        """
+        Called when sale dates are saved, bringing the next sale
+        boundary forward if any of the given times occur before it.
+        """
+        state = cache.get(SALE_BOUNDARIES_CACHE_KEY)
+        if state is None:
+            return
+        n = now()
+        for boundary in boundaries:
+            if boundary is not None and boundary > n and (
+                state["next"] is None or boundary < state["next"]):
+                state["next"] = boundary
+        cache.set(SALE_BOUNDARIES_CACHE_KEY, state,
+                  SALE_BOUNDARIES_CACHE_SECONDS)
+
+
 class ProductActionManager(Manager):
 
     use_for_related_fields = True
 
+    def increment(self, product_id, field, count=1):
+        """
+        Increases the given field for the product and the current
+        timestamp, datetime.today().toordinal(), which provides a time
+        scaling value we can order by to determine popularity over
+        time. Counts are buffered in the process and written by
+        ``flush`` once each request has finished, unless
+        ``SHOP_PRODUCT_ACTION_FLUSH_SECONDS`` is zero in which case
+        they're written immediately.
+        """
+        key = (product_id, datetime.today().toordinal(), field)
+        with _action_buffer_lock:
+            _action_buffer[key] += count
+        if not settings.SHOP_PRODUCT_ACTION_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self, due_only=False):
+        """
+        Writes the buffered counts, inserting any missing rows in bulk
+        and then adding to the existing rows with atomic updates, one
+        for each group of rows with the same increases. If
+        ``due_only`` is given, as when a request has finished, the
+        counts are only written once
+        ``SHOP_PRODUCT_ACTION_FLUSH_SECONDS`` have passed since the
+        last write. If writing fails, the counts are put back into the
+        buffer to be written by the next flush.
+        """
+        with _action_buffer_lock:
+            if due_only and time() - _action_buffer_flushed[0] < (
+                settings.SHOP_PRODUCT_ACTION_FLUSH_SECONDS):
+                return
+            pending = dict(_action_buffer)
+            _action_buffer.clear()
+            _action_buffer_flushed[0] = time()
+        if not pending:
+            return
+        try:
+            self.model.objects._write_counts(pending)
+        except:
+            with _action_buffer_lock:
+                for key, count in pending.items():
+                    _action_buffer[key] += count
+            raise
+
+    @transaction.commit_on_success
+    def _write_counts(self, pending):
+        """
+        Writes the counts from ``flush``, skipping products that have
+        been deleted since their counts were buffered.
+        """
+        from cartridge.shop.models import Product
+        increases = defaultdict(dict)
+        for (product_id, timestamp, field), count in pending.items():
+            increases[(product_id, timestamp)][field] = count
+        product_ids = list(set([key[0] for key in increases]))
+        existing = set()
+        for i in range(0, len(product_ids), BULK_BATCH_SIZE):
+            products = Product.objects.filter(
+                id__in=product_ids[i:i + BULK_BATCH_SIZE])
+            existing.update(products.values_list("id", flat=True))
+        # Group the rows with the same timestamp and increases.
+        groups = defaultdict(list)
+        for (product_id, timestamp), fields in increases.items():
+            if product_id in existing:
+                key = (timestamp, tuple(sorted(fields.items())))
+                groups[key].append(product_id)
+        for (timestamp, fields), product_ids in groups.items():
+            update = dict([(field, F(field) + count)
+                           for field, count in fields], counted=False)
+            for i in range(0, len(product_ids), BULK_BATCH_SIZE):
+                batch = product_ids[i:i + BULK_BATCH_SIZE]
+                self._create_missing(timestamp, batch)
+                self.filter(timestamp=timestamp,
+                            product__in=batch).update(**update)
+
+    def _create_missing(self, timestamp, product_ids):
+        """
+        Inserts the rows for the timestamp that don't exist yet for
+        the given products, in bulk.
+        """
+        actions = self.filter(timestamp=timestamp, product__in=product_ids)
+        existing = set(actions.values_list("product_id", flat=True))
+        missing = [self.model(product_id=product_id, timestamp=timestamp)
+                   for product_id in product_ids
+                   if product_id not in existing]
+        if not missing:
+            return
+        # Rows may be inserted by another process in the meantime, in
+        # which case fall back to creating each row that's missing.
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create(missing)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            for action in missing:
+                self.get_or_create(product_id=action.product_id,
+                                   timestamp=timestamp)
+
+    @transaction.commit_on_success
+    def update_popularity(self):
+        """
+        Updates the popularity score stored on each product, with the
+        counts for each day up to yesterday that haven't yet been
+        added to it. Each day's counts are weighted by
+        ``POPULARITY_WEIGHTS`` and halved for every
+        ``SHOP_POPULARITY_HALF_LIFE`` days since, so existing scores
+        are decayed by the days passed since they were last updated,
+        stored in ``popularity_timestamp``, and then the new counts
+        are added. The totals added are stored on each day's row, so
+        that counts written by other processes after their day has
+        been added are picked up by the next call. Returns the number
+        of products whose score was increased.
+        """
+        from cartridge.shop.models import Product
+        self.flush()
+        yesterday = datetime.today().toordinal() - 1
+        half_life = float(settings.SHOP_POPULARITY_HALF_LIFE)
+        decay = lambda days: 0.5 ** (days / half_life)
+        last = Product.objects.aggregate(last=Max("popularity_timestamp"))
+        last = last["last"]
+        if last is not None and last < yesterday:
+            scored = Product.objects.filter(popularity__gt=0)
+            scored.update(popularity=F("popularity") *
+                          decay(yesterday - last),
+                          popularity_timestamp=yesterday)
+            # Drop scores too small to affect the order of products.
+            scored.filter(popularity__lt=POPULARITY_MIN).update(popularity=0)
+        fields = POPULARITY_COUNTED_FIELDS.items()
+        scores = defaultdict(float)
+        counted = defaultdict(list)
+        actions = self.filter(counted=False, timestamp__lte=yesterday)
+        for action in actions.values():
+            weight = decay(yesterday - action["timestamp"])
+            for field, counted_field in fields:
+                count = action[field] - action[counted_field]
+                scores[action["product_id"]] += (
+                    count * POPULARITY_WEIGHTS[field] * weight)
+            totals = tuple([action[field] for field, _ in fields])
+            counted[totals].append(action["id"])
+        # Group the products with the same increase in score.
+        increases = defaultdict(list)
+        for product_id, score in scores.items():
+            if score > 0:
+                increases[round(score, 6)].append(product_id)
+        for score, product_ids in increases.items():
+            for i in range(0, len(product_ids), BULK_BATCH_SIZE):
+                batch = product_ids[i:i + BULK_BATCH_SIZE]
+                Product.objects.filter(id__in=batch).update(
+                    popularity=F("popularity") + score,
+                    popularity_timestamp=yesterday)
+        # Store the totals added, leaving the rows increased since
+        # they were read to be added by the next call.
+        for totals, ids in counted.items():
+            update = dict([(counted_field, total) for (_, counted_field),
+                           total in zip(fields, totals)])
+            unchanged = dict([(field, F(counted_field))
+                              for field, counted_field in fields])
+            for i in range(0, len(ids), BULK_BATCH_SIZE):
+                batch = self.filter(id__in=ids[i:i + BULK_BATCH_SIZE])
+                batch.update(**update)
+                batch.filter(**unchanged).update(counted=True)
+        return sum([len(product_ids) for product_ids in increases.values()])
+
     def _action_for_field(self, field):
         """
-        Increases the given field by datetime.today().toordinal()
-        which provides a time scaling value we can order by to
-        determine popularity over time.
+        Increases the given field for the product the manager is
+        related to.
         """
-        timestamp = datetime.today().toordinal()
-        action, created = self.get_or_create(timestamp=timestamp)
-        setattr(action, field, getattr(action, field) + 1)
-        action.save()
+        self.increment(self.instance.id, field)
 
     def added_to_cart(self):
         """
@@ -164,6 +812,175 @@ class ProductActionManager(Manager):
         self._action_for_field("total_purchase")
 
 
+class SalesSummaryManager(Manager):
+
+    @transaction.commit_on_success
+    def add_orders(self, orders, product_ids=None):
+        """
+        Adds the given sequence of orders and their items, as pairs,
+        to the daily summaries for all orders and for each SKU,
+        category and discount code. Categories are those each product
+        is listed in by ``CategoryProduct``. A dict mapping SKUs to
+        product IDs can be given if already known.
+        """
+        self._add_orders(orders, product_ids)
+
+    def _add_orders(self, orders, product_ids=None):
+        """
+        Adds the orders for ``add_orders``, within the caller's
+        transaction.
+        """
+        from cartridge.shop.models import CategoryProduct, ProductVariation
+        skus = set([item.sku for order, items in orders for item in items])
+        if product_ids is None:
+            product_ids = {}
+            skus = list(skus)
+            for i in range(0, len(skus), BULK_BATCH_SIZE):
+                variations = ProductVariation.objects.filter(
+                    sku__in=skus[i:i + BULK_BATCH_SIZE])
+                product_ids.update(variations.values_list("sku", "product"))
+        categories = defaultdict(list)
+        product_list = list(set(product_ids.values()))
+        for i in range(0, len(product_list), BULK_BATCH_SIZE):
+            indexed = CategoryProduct.objects.filter(
+                product__in=product_list[i:i + BULK_BATCH_SIZE])
+            for product_id, category_id, title in indexed.values_list(
+                    "product", "category", "category__title"):
+                categories[product_id].append((category_id, title))
+        totals = SortedDict()
+
+        def add(day, dimension, key, description, quantity, revenue,
+                discount_total=0):
+            key = (day, dimension, unicode(key))
+            if key not in totals:
+                totals[key] = {"description": description, "orders": 0,
+                               "quantity": 0, "revenue": 0,
+                               "discount_total": 0}
+            totals[key]["orders"] += 1
+            totals[key]["quantity"] += quantity
+            totals[key]["revenue"] += revenue
+            totals[key]["discount_total"] += discount_total
+
+        # Time zones are only supported from Django 1.4, otherwise
+        # order times are already local.
+        localtime = lambda value: value
+        if getattr(settings, "USE_TZ", False):
+            from django.utils.timezone import localtime
+
+        for order, items in orders:
+            day = localtime(order.time).date()
+            # Combine the order's items by SKU and by category, so
+            # that each is counted as a single order.
+            by_sku = SortedDict()
+            by_category = SortedDict()
+            for item in items:
+                keys = [(by_sku, item.sku, item.description)]
+                product_id = product_ids.get(item.sku)
+                for category_id, title in categories.get(product_id, []):
+                    keys.append((by_category, category_id, title))
+                for combined, key, description in keys:
+                    if key not in combined:
+                        combined[key] = [description, 0, 0]
+                    combined[key][1] += item.quantity
+                    combined[key][2] += item.total_price or 0
+            quantity = sum([item.quantity for item in items])
+            revenue = order.total or 0
+            discount_total = order.discount_total or 0
+            add(day, "total", "", "", quantity, revenue, discount_total)
+            if order.discount_code:
+                add(day, "discount_code", order.discount_code,
+                    order.discount_code, quantity, revenue, discount_total)
+            for dimension, combined in (("sku", by_sku),
+                                        ("category", by_category)):
+                for key, values in combined.items():
+                    add(day, dimension, key, *values)
+
+        for (day, dimension, key), values in totals.items():
+            lookup = {"date": day, "dimension": dimension, "key": key}
+            update = dict([(field, F(field) + values[field]) for field in
+                           ("orders", "quantity", "revenue",
+                            "discount_total")])
+            if self.filter(**lookup).update(**update):
+                continue
+            # No summary for the day yet - create it, unless it's
+            # created by another process in the meantime.
+            sid = transaction.savepoint()
+            try:
+                self.create(**dict(lookup, **values))
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                self.filter(**lookup).update(**update)
+
+    @transaction.commit_on_success
+    def add_pending(self, chunk_size=BULK_BATCH_SIZE):
+        """
+        Adds the orders flagged by ``Order.complete`` as pending, in
+        chunks of orders, and clears their flag. Called periodically
+        by the ``update_sales_summaries`` command rather than as each
+        order is completed, so that concurrent checkouts don't contend
+        on the summaries for the same day. Returns the number of
+        orders added.
+        """
+        from cartridge.shop.models import Order
+        pending = Order.objects.select_for_update().filter(
+            summary_pending=True)
+        ids = list(pending.order_by("id").values_list("id", flat=True))
+        for i in range(0, len(ids), chunk_size):
+            orders = Order.objects.filter(id__in=ids[i:i + chunk_size])
+            orders = list(orders.prefetch_related("items"))
+            self._add_orders([(order, order.items.all())
+                              for order in orders])
+            orders = Order.objects.filter(id__in=ids[i:i + chunk_size])
+            orders.update(summary_pending=False)
+        return len(ids)
+
+    @transaction.commit_on_success
+    def rebuild(self, start=None, end=None, chunk_size=BULK_BATCH_SIZE):
+        """
+        Deletes the summaries from the ``start`` date to the ``end``
+        date inclusive, or for all dates if not given, and adds the
+        orders for those dates again in chunks of orders. This occurs
+        in a single transaction, so the summaries are never seen part
+        way through being rebuilt. Orders still pending are left for
+        ``add_pending``. Returns the number of orders added.
+        """
+        from cartridge.shop.models import Order
+        summaries = self.all()
+        orders = Order.objects.filter(summary_pending=False)
+        if start is not None:
+            summaries = summaries.filter(date__gte=start)
+            orders = orders.filter(time__gte=_start_of_day(start))
+        if end is not None:
+            summaries = summaries.filter(date__lte=end)
+            orders = orders.filter(
+                time__lt=_start_of_day(end + timedelta(days=1)))
+        summaries.delete()
+        total = 0
+        last_id = 0
+        while True:
+            chunk = orders.filter(id__gt=last_id).order_by("id")
+            chunk = list(chunk.prefetch_related("items")[:chunk_size])
+            if not chunk:
+                break
+            self._add_orders([(order, order.items.all())
+                              for order in chunk])
+            total += len(chunk)
+            last_id = chunk[-1].id
+        return total
+
+
+def _start_of_day(day):
+    """
+    Returns the time the given date starts, in the default time zone
+    if time zones are used, for comparing with order times.
+    """
+    start = datetime(day.year, day.month, day.day)
+    if getattr(settings, "USE_TZ", False):
+        start = make_aware(start)
+    return start
+
+
 class DiscountCodeManager(Manager):
 
     def active(self, *args, **kwargs):
@@ -184,8 +1001,6 @@ class DiscountCodeManager(Manager):
         total_price_valid = (Q(min_purchase__isnull=True) |
                              Q(min_purchase__lte=cart.total_price()))
         discount = self.active().get(total_price_valid, code=code)
-        products = discount.all_products()
-        if products.count() > 0:
-            if products.filter(variations__sku__in=cart.skus()).count() == 0:
-                raise self.model.DoesNotExist
+        if cart.discount_skus(discount) == set():
+            raise self.model.DoesNotExist
         return discount
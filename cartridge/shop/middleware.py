@@ -1,4 +1,5 @@
 
+from django.utils.functional import SimpleLazyObject, new_method_proxy
 from mezzanine.conf import settings
 
 from cartridge.shop.models import Cart
@@ -23,12 +24,21 @@ class SSLRedirect(object):
                 break
 
 
+class LazyCart(SimpleLazyObject):
+    """
+    Retrieves the cart for the request the first time it's used.
+    Iterating the cart's items is proxied here since special methods
+    aren't proxied by ``SimpleLazyObject``.
+    """
+    __iter__ = new_method_proxy(iter)
+
+
 class ShopMiddleware(SSLRedirect):
     """
     Adds cart and wishlist attributes to the current request.
     """
     def process_request(self, request):
-        request.cart = Cart.objects.from_request(request)
+        request.cart = LazyCart(lambda: Cart.objects.from_request(request))
         wishlist = request.COOKIES.get("wishlist", "").split(",")
         if not wishlist[0]:
             wishlist = []
@@ -1,15 +1,17 @@
 
 from decimal import Decimal
+from logging import getLogger
 from operator import iand, ior
 
+from django.core.signals import request_finished
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
 from django.db.models import CharField, Q
 from django.db.models.base import ModelBase
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 from mezzanine.conf import settings
-from mezzanine.core.managers import DisplayableManager
 from mezzanine.core.models import Displayable, RichText, Orderable
 from mezzanine.generic.fields import RatingField
 from mezzanine.pages.models import Page
@@ -17,14 +19,15 @@ from mezzanine.utils.timezone import now
 
 from cartridge.shop import fields, managers
 
-try:
-    from _mysql_exceptions import OperationalError
-except ImportError:
-    class OperationalError(StandardError):
-        """
-        This class is purely to prevent a NameError if
-        _mysql_exceptions.OperationalError is not available.
-        """
+
+logger = getLogger(__name__)
+
+SALES_SUMMARY_DIMENSIONS = (
+    ("total", _("All orders")),
+    ("sku", _("SKU")),
+    ("category", _("Category")),
+    ("discount_code", _("Discount code")),
+)
 
 
 class Category(Page, RichText):
@@ -56,38 +59,34 @@ class Category(Page, RichText):
         if options:
             lookup = dict([("%s__in" % k, v) for k, v in options.items()])
             filters.append(Q(**lookup))
-        # Q objects used against variations to ensure sale date is
-        # valid when filtering by sale, or sale price.
-        n = now()
-        valid_sale_from = Q(sale_from__isnull=True) | Q(sale_from__lte=n)
-        valid_sale_to = Q(sale_to__isnull=True) | Q(sale_to__gte=n)
-        valid_sale_date = valid_sale_from & valid_sale_to
-        # Filter by variations with the selected sale if the sale date
-        # is valid.
+        # Filter by variations with the selected sale if the sale is
+        # in effect.
         if self.sale_id:
-            filters.append(Q(sale_id=self.sale_id) & valid_sale_date)
-        # If a price range is specified, use either the unit price or
-        # a sale price if the sale date is valid.
+            filters.append(Q(sale_id=self.sale_id,
+                             effective_price=models.F("sale_price")))
+        # If a price range is specified, use the price in effect,
+        # either the unit price or the sale price.
         if self.price_min or self.price_max:
             prices = []
             if self.price_min:
-                sale = Q(sale_price__gte=self.price_min) & valid_sale_date
-                prices.append(Q(unit_price__gte=self.price_min) | sale)
+                prices.append(Q(effective_price__gte=self.price_min))
             if self.price_max:
-                sale = Q(sale_price__lte=self.price_max) & valid_sale_date
-                prices.append(Q(unit_price__lte=self.price_max) | sale)
+                prices.append(Q(effective_price__lte=self.price_max))
             filters.append(reduce(iand, prices))
         # Turn the variation filters into a product filter.
         operator = iand if self.combined else ior
-        category_products = self.products.only("id")
-        if category_products:
-            if filters:
-                filters = reduce(operator, filters)
-                variations = ProductVariation.objects.filter(filters)
-                filters = [Q(variations__in=variations)]
-                filters.append(Q(id__in=category_products))
-                return reduce(operator, filters)
-        return Q(id__in=category_products)
+        products = Q(id__in=self.products.only("id"))
+        if filters:
+            filters = reduce(operator, filters)
+            variations = ProductVariation.objects.filter(filters)
+            filters = [Q(variations__in=variations)]
+            # Only combine with the selected products if there are
+            # any, since ``AND`` with an empty ID lookup would never
+            # match anything.
+            if self.products.count() > 0:
+                filters.append(products)
+            return reduce(operator, filters)
+        return products
 
 
 class Priced(models.Model):
@@ -99,36 +98,77 @@ class Priced(models.Model):
     unit_price = fields.MoneyField(_("Unit price"))
     sale_id = models.IntegerField(null=True)
     sale_price = fields.MoneyField(_("Sale price"))
-    sale_from = models.DateTimeField(_("Sale start"), blank=True, null=True)
-    sale_to = models.DateTimeField(_("Sale end"), blank=True, null=True)
+    sale_from = models.DateTimeField(_("Sale start"), blank=True, null=True,
+                                     db_index=True)
+    sale_to = models.DateTimeField(_("Sale end"), blank=True, null=True,
+                                   db_index=True)
+    effective_price = fields.MoneyField(_("Price"), editable=False,
+                                        db_index=True)
 
     class Meta:
         abstract = True
 
-    def on_sale(self):
+    def save(self, *args, **kwargs):
         """
-        Returns True if the sale price is applicable.
+        Store the price in effect as the instance is saved.
+        """
+        self.update_effective_price()
+        super(Priced, self).save(*args, **kwargs)
+
+    def update_effective_price(self):
+        """
+        Sets ``effective_price`` to the sale price if the sale dates
+        are valid, otherwise the unit price. Once a sale starts or
+        ends, ``effective_price`` is updated for the sale's products
+        and variations by ``update_effective_prices``, called from
+        ``CategoryProductManager.update_sales``.
         """
         n = now()
         valid_from = self.sale_from is None or self.sale_from < n
         valid_to = self.sale_to is None or self.sale_to > n
-        return self.sale_price is not None and valid_from and valid_to
+        if self.sale_price is not None and valid_from and valid_to:
+            self.effective_price = self.sale_price
+        else:
+            self.effective_price = self.unit_price
+
+    @classmethod
+    def update_effective_prices(cls, ids=None):
+        """
+        Queryset equivalent of ``update_effective_price``, for
+        instances with prices changed by queryset updates, or whose
+        sale has started or ended. Updates the instances with the
+        given IDs, or all instances if no IDs are given.
+        """
+        n = now()
+        on_sale = (Q(sale_price__isnull=False) &
+                   (Q(sale_from__isnull=True) | Q(sale_from__lt=n)) &
+                   (Q(sale_to__isnull=True) | Q(sale_to__gt=n)))
+        objects = cls.objects.all()
+        if ids is not None:
+            objects = objects.filter(id__in=ids)
+        objects.filter(on_sale).update(effective_price=models.F("sale_price"))
+        objects.exclude(on_sale).update(effective_price=models.F("unit_price"))
+
+    def on_sale(self):
+        """
+        Returns True if the sale price is applicable.
+        """
+        return (self.sale_price is not None and
+                self.effective_price == self.sale_price)
 
     def has_price(self):
         """
         Returns True if there is a valid price.
         """
-        return self.on_sale() or self.unit_price is not None
+        return self.effective_price is not None
 
     def price(self):
         """
         Returns the actual price - sale price if applicable otherwise
         the unit price.
         """
-        if self.on_sale():
-            return self.sale_price
-        elif self.has_price():
-            return self.unit_price
+        if self.has_price():
+            return self.effective_price
         return Decimal("0")
 
 
@@ -148,8 +188,11 @@ class Product(Displayable, Priced, RichText):
     related_products = models.ManyToManyField("self", blank=True)
     upsell_products = models.ManyToManyField("self", blank=True)
     rating = RatingField(verbose_name=_("Rating"))
+    popularity = models.FloatField(default=0, db_index=True, editable=False)
+    popularity_timestamp = models.IntegerField(null=True, db_index=True,
+                                               editable=False)
 
-    objects = DisplayableManager()
+    objects = managers.ProductManager()
 
     class Meta:
         verbose_name = _("Product")
@@ -249,6 +292,7 @@ class ProductVariation(Priced):
     sku = fields.SKUField(unique=True)
     num_in_stock = models.IntegerField(_("Number in stock"), blank=True,
                                        null=True)
+    num_in_carts = models.IntegerField(default=0, editable=False)
     default = models.BooleanField(_("Default"))
     image = models.ForeignKey("ProductImage", null=True, blank=True)
 
@@ -293,6 +337,23 @@ class ProductVariation(Priced):
         all_fields = cls._meta.fields
         return [f for f in all_fields if isinstance(f, fields.OptionField)]
 
+    @classmethod
+    def option_values(cls, variations):
+        """
+        Returns the name of each option field used by the given
+        variations that have a price, along with the values used for
+        it, collected in a single pass over the variations.
+        """
+        names = [f.name for f in cls.option_fields()]
+        values = dict([(name, set()) for name in names])
+        for variation in variations:
+            if variation.unit_price is not None:
+                for name in names:
+                    value = getattr(variation, name)
+                    if value:
+                        values[name].add(value)
+        return [(name, list(values[name])) for name in names if values[name]]
+
     def options(self):
         """
         Returns the field values of each of the model fields that are
@@ -304,20 +365,12 @@ class ProductVariation(Priced):
     def live_num_in_stock(self):
         """
         Returns the live number in stock, which is
-        ``self.num_in_stock - num in carts``. Also caches the value
-        for subsequent lookups.
+        ``self.num_in_stock - self.num_in_carts``. ``num_in_carts`` is
+        maintained as cart items are saved and deleted.
         """
         if self.num_in_stock is None:
             return None
-        if not hasattr(self, "_cached_num_in_stock"):
-            num_in_stock = self.num_in_stock
-            items = CartItem.objects.filter(sku=self.sku)
-            aggregate = items.aggregate(quantity_sum=models.Sum("quantity"))
-            num_in_carts = aggregate["quantity_sum"]
-            if num_in_carts is not None:
-                num_in_stock = num_in_stock - num_in_carts
-            self._cached_num_in_stock = num_in_stock
-        return self._cached_num_in_stock
+        return self.num_in_stock - self.num_in_carts
 
     def has_stock(self, quantity=1):
         """
@@ -330,6 +383,23 @@ class ProductVariation(Priced):
         return live is None or quantity == 0 or live >= quantity
 
 
+class CategoryProduct(models.Model):
+    """
+    Stores the products matched by each category's filters, so that
+    listing a category's products is a single join rather than the
+    evaluation of ``Category.filters()``. Kept up to date as
+    categories, products, variations and sales are saved.
+    """
+
+    category = models.ForeignKey("Category", related_name="product_index")
+    product = models.ForeignKey("Product", related_name="category_index")
+
+    objects = managers.CategoryProductManager()
+
+    class Meta:
+        unique_together = ("category", "product")
+
+
 class Order(models.Model):
 
     billing_detail_first_name = CharField(_("First name"), max_length=100)
@@ -366,6 +436,10 @@ class Order(models.Model):
     status = models.IntegerField(_("Status"),
                             choices=settings.SHOP_ORDER_STATUS_CHOICES,
                             default=settings.SHOP_ORDER_STATUS_CHOICES[0][0])
+    # Set by complete() until the order is added to the sales summaries
+    # by the ``update_sales_summaries`` command.
+    summary_pending = models.BooleanField(default=False, db_index=True,
+                                          editable=False)
 
     objects = managers.OrderManager()
 
@@ -373,6 +447,10 @@ class Order(models.Model):
     # the order in setup() and removed from the session in complete().
     session_fields = ("shipping_type", "shipping_total", "discount_total")
 
+    # Set by reserve_stock() once the stock for the order's items has
+    # been reduced ahead of payment, so complete() doesn't reduce it.
+    stock_reserved = False
+
     class Meta:
         verbose_name = _("Order")
         verbose_name_plural = _("Orders")
@@ -409,28 +487,73 @@ class Order(models.Model):
             item = dict([(f, getattr(item, f)) for f in product_fields])
             self.items.create(**item)
 
+    def reserve_stock(self):
+        """
+        Reduce the stock level for the items in the order before
+        payment is taken, so that they can't be sold twice while the
+        payment is processed. If any of the items don't have enough
+        stock, the reductions are rolled back and the SKUs without
+        enough stock are returned. Otherwise ``release_stock`` should
+        be called if the payment fails.
+        """
+        failed = ProductVariation.objects.reduce_stock(self.item_quantities())
+        self.stock_reserved = not failed
+        return failed
+
+    def release_stock(self):
+        """
+        Restore the stock level for the items in the order, reserved
+        by ``reserve_stock``, when the payment fails.
+        """
+        if self.stock_reserved:
+            ProductVariation.objects.restore_stock(self.item_quantities())
+            self.stock_reserved = False
+
+    def item_quantities(self):
+        """
+        Returns a dict of the order's SKUs and their total quantities.
+        """
+        quantities = {}
+        for sku, quantity in self.items.values_list("sku", "quantity"):
+            quantities[sku] = quantities.get(sku, 0) + quantity
+        return quantities
+
     def complete(self, request):
         """
         Remove order fields that are stored in the session, reduce
-        the stock level for the items in the order, and then delete
-        the cart.
+        the stock level for the items in the order unless it was
+        reserved before payment, flag the order to be added to the
+        sales summaries by the next ``update_sales_summaries`` run,
+        and then delete the cart. The order has been
+        paid for, so items without enough stock have their stock level
+        set to zero and are logged. Returns the SKUs that didn't have
+        enough stock.
         """
+        self.summary_pending = True
         self.save()  # Save the transaction ID.
         for field in self.session_fields:
             if field in request.session:
                 del request.session[field]
         del request.session["order"]
-        for item in request.cart:
-            try:
-                variation = ProductVariation.objects.get(sku=item.sku)
-            except ProductVariation.DoesNotExist:
-                pass
-            else:
-                if variation.num_in_stock is not None:
-                    variation.num_in_stock -= item.quantity
-                    variation.save()
-                variation.product.actions.purchased()
-        request.cart.delete()
+        items = list(request.cart)
+        out_of_stock = []
+        if not self.stock_reserved:
+            out_of_stock = ProductVariation.objects.reduce_stock(
+                self.item_quantities(), clamp=True)
+            if out_of_stock:
+                logger.warning("Order %s was completed for SKUs without "
+                               "enough stock: %s" %
+                               (self.id, ", ".join(out_of_stock)))
+        skus = set([item.sku for item in items])
+        variations = ProductVariation.objects.filter(sku__in=skus)
+        product_ids = dict(variations.values_list("sku", "product"))
+        for item in items:
+            product_id = product_ids.get(item.sku)
+            if product_id is not None:
+                ProductAction.objects.increment(product_id, "total_purchase")
+        if request.cart.id is not None:
+            request.cart.delete()
+        return out_of_stock
 
     def details_as_dict(self):
         """
@@ -460,7 +583,11 @@ class Order(models.Model):
 
 class Cart(models.Model):
 
-    last_updated = models.DateTimeField(_("Last updated"), null=True)
+    last_updated = models.DateTimeField(_("Last updated"), null=True,
+                                        db_index=True)
+    item_count = models.IntegerField(default=0, editable=False)
+    item_quantity = models.IntegerField(default=0, editable=False)
+    item_total = fields.MoneyField(default=Decimal("0"), editable=False)
 
     objects = managers.CartManager()
 
@@ -470,14 +597,24 @@ class Cart(models.Model):
         ensuring the items are only retrieved once and cached.
         """
         if not hasattr(self, "_cached_items"):
-            self._cached_items = self.items.all()
+            if self.id is None:
+                self._cached_items = []
+            else:
+                self._cached_items = self.items.all()
         return iter(self._cached_items)
 
     def add_item(self, variation, quantity):
         """
         Increase quantity of existing item if SKU matches, otherwise create
-        new.
+        new. The cart itself is saved if this is its first item, and
+        its ID stored in the session it was created for.
         """
+        if self.id is None:
+            self.last_updated = now()
+            self.save()
+            session = getattr(self, "_session", None)
+            if session is not None:
+                session["cart"] = self.id
         kwargs = {"sku": variation.sku, "unit_price": variation.price()}
         item, created = self.items.get_or_create(**kwargs)
         if created:
@@ -490,24 +627,39 @@ class Cart(models.Model):
             variation.product.actions.added_to_cart()
         item.quantity += quantity
         item.save()
+        # The stored totals are updated by ``CartItem.save``, so keep
+        # this instance's totals in line with them.
+        self.item_count += int(created)
+        self.item_quantity += quantity
+        self.item_total += item.unit_price * quantity
+        self.clear_cached()
+
+    def clear_cached(self):
+        """
+        Removes the items and discount SKUs cached for the cart, once
+        its items have changed.
+        """
+        for name in ("_cached_items", "_discount_skus"):
+            if hasattr(self, name):
+                delattr(self, name)
 
     def has_items(self):
         """
         Template helper function - does the cart have items?
         """
-        return len(list(self)) > 0
+        return self.item_count > 0
 
     def total_quantity(self):
         """
         Template helper function - sum of all item quantities.
         """
-        return sum([item.quantity for item in self])
+        return self.item_quantity
 
     def total_price(self):
         """
         Template helper function - sum of all costs of item quantities.
         """
-        return sum([item.total_price for item in self])
+        return self.item_total
 
     def skus(self):
         """
@@ -526,26 +678,133 @@ class Cart(models.Model):
         with_cart_excluded = for_cart.exclude(variations__sku__in=self.skus())
         return list(with_cart_excluded.distinct())
 
+    def discount_skus(self, discount):
+        """
+        Returns the set of skus in the cart that the discount applies
+        to, or ``None`` if the discount isn't product specific. The
+        result is cached for each discount, since it's used both when
+        validating a discount code and when calculating its discount.
+        """
+        if not hasattr(self, "_discount_skus"):
+            self._discount_skus = {}
+        if discount.id not in self._discount_skus:
+            skus = None
+            products = discount.all_products()
+            if products.exists():
+                lookup = {"product__in": products, "sku__in": self.skus()}
+                variations = ProductVariation.objects.filter(**lookup)
+                skus = set(variations.values_list("sku", flat=True))
+            self._discount_skus[discount.id] = skus
+        return self._discount_skus[discount.id]
+
     def calculate_discount(self, discount):
         """
         Calculates the discount based on the items in a cart, some
         might have the discount, others might not.
         """
         # Discount applies to cart total if not product specific.
-        products = discount.all_products()
-        if products.count() == 0:
+        discount_skus = self.discount_skus(discount)
+        if discount_skus is None:
             return discount.calculate(self.total_price())
         total = Decimal("0")
-        # Create a list of skus in the cart that are applicable to
-        # the discount, and total the discount for appllicable items.
-        lookup = {"product__in": products, "sku__in": self.skus()}
-        discount_variations = ProductVariation.objects.filter(**lookup)
-        discount_skus = discount_variations.values_list("sku", flat=True)
+        # Total the discount for the items applicable to the discount.
         for item in self:
             if item.sku in discount_skus:
                 total += discount.calculate(item.unit_price) * item.quantity
         return total
 
+    def store(self):
+        """
+        Returns the cart as stored in the database, for carts that are
+        kept elsewhere until checkout. See ``SessionCart``.
+        """
+        return self
+
+
+class SessionCart(Cart):
+    """
+    A cart whose items are kept in the session rather than the
+    database, used for anonymous users when
+    ``SHOP_CART_SESSION_STORAGE`` is ``True``. The cart and its items
+    are stored in the database by ``store`` once the user edits the
+    cart or checks out.
+    """
+
+    class Meta:
+        proxy = True
+
+    def __iter__(self):
+        """
+        Returns unsaved cart items for the item fields in the session.
+        """
+        if not hasattr(self, "_cached_items"):
+            self._cached_items = []
+            for fields in self._session.get("cart_items", []):
+                item = CartItem(**fields)
+                item.total_price = item.unit_price * item.quantity
+                self._cached_items.append(item)
+        return iter(self._cached_items)
+
+    def add_item(self, variation, quantity):
+        """
+        Increase quantity of existing item if SKU matches, otherwise add
+        new item fields to the session.
+        """
+        items = self._session.get("cart_items", [])
+        for item in items:
+            if (item["sku"] == variation.sku and
+                item["unit_price"] == variation.price()):
+                item["quantity"] += quantity
+                break
+        else:
+            image = variation.image
+            items.append({
+                "sku": variation.sku,
+                "description": unicode(variation),
+                "unit_price": variation.price(),
+                "url": variation.product.get_absolute_url(),
+                "image": unicode(image.file) if image is not None else None,
+                "quantity": quantity,
+            })
+            variation.product.actions.added_to_cart()
+        self._session["cart_items"] = items
+        self.clear_cached()
+
+    def has_items(self):
+        """
+        Template helper function - does the cart have items?
+        """
+        return len(list(self)) > 0
+
+    def total_quantity(self):
+        """
+        Template helper function - sum of all item quantities.
+        """
+        return sum([item.quantity for item in self])
+
+    def total_price(self):
+        """
+        Template helper function - sum of all costs of item quantities.
+        """
+        return sum([item.total_price for item in self])
+
+    def store(self):
+        """
+        Saves the cart and its items to the database if it has any
+        items, removing them from the session, and returns the stored
+        cart.
+        """
+        if not self.has_items():
+            return self
+        cart = Cart.objects.create(last_updated=now())
+        for item in self:
+            item.cart = cart
+            item.save()
+        self._session["cart"] = cart.id
+        del self._session["cart_items"]
+        # Retrieve the totals added by saving the items.
+        return Cart.objects.get(id=cart.id)
+
 
 class SelectedProduct(models.Model):
     """
@@ -575,6 +834,32 @@ class CartItem(SelectedProduct):
     url = CharField(max_length=200)
     image = CharField(max_length=200, null=True)
 
+    def __init__(self, *args, **kwargs):
+        super(CartItem, self).__init__(*args, **kwargs)
+        # The quantity and total last saved, for keeping the
+        # variation's ``num_in_carts`` and the cart's totals up to date.
+        self._saved_quantity = self.quantity if self.id else 0
+        self._saved_total = self.total_price if self.id else 0
+
+    def save(self, *args, **kwargs):
+        """
+        Add any change in quantity to the variation's ``num_in_carts``,
+        and any change in quantity or price to the cart's totals.
+        """
+        created = self.id is None
+        super(CartItem, self).save(*args, **kwargs)
+        quantity = self.quantity - self._saved_quantity
+        total = self.total_price - self._saved_total
+        if quantity:
+            ProductVariation.objects.reserve(self.sku, quantity)
+        if created or quantity or total:
+            Cart.objects.filter(id=self.cart_id).update(
+                item_count=models.F("item_count") + int(created),
+                item_quantity=models.F("item_quantity") + quantity,
+                item_total=models.F("item_total") + total)
+        self._saved_quantity = self.quantity
+        self._saved_total = self.total_price
+
     def get_absolute_url(self):
         return self.url
 
@@ -590,14 +875,19 @@ class ProductAction(models.Model):
     """
     Records an incremental value for an action against a product such
     as adding to cart or purchasing, for sales reporting and
-    calculating popularity. Not yet used but will be used for product
-    popularity and sales reporting.
+    calculating popularity, which is stored on each product by
+    ``ProductActionManager.update_popularity``.
     """
 
     product = models.ForeignKey("Product", related_name="actions")
     timestamp = models.IntegerField()
     total_cart = models.IntegerField(default=0)
     total_purchase = models.IntegerField(default=0)
+    # The totals already added to the product's popularity, so that
+    # counts written after their day has been added are added later.
+    counted_cart = models.IntegerField(default=0)
+    counted_purchase = models.IntegerField(default=0)
+    counted = models.BooleanField(default=False, db_index=True)
 
     objects = managers.ProductActionManager()
 
@@ -605,6 +895,41 @@ class ProductAction(models.Model):
         unique_together = ("product", "timestamp")
 
 
+class SalesSummary(models.Model):
+    """
+    Daily totals of completed orders, for all orders and for each
+    SKU, category and discount code, so that sales can be reported on
+    without scanning ``Order`` and ``OrderItem``. Completed orders are
+    added by the ``update_sales_summaries`` management command, and
+    summaries are rebuilt from existing orders by the
+    ``rebuild_sales_summaries`` management command.
+
+    Orders aren't added while they're completed, so the summaries lag
+    behind the orders by up to the interval ``update_sales_summaries``
+    is scheduled to run at, and don't include any orders if it isn't
+    scheduled at all.
+    """
+
+    date = models.DateField(_("Date"), db_index=True)
+    dimension = CharField(_("Summary of"), max_length=20,
+                          choices=SALES_SUMMARY_DIMENSIONS)
+    key = CharField(max_length=100, blank=True)
+    description = CharField(_("Description"), max_length=200, blank=True)
+    orders = models.IntegerField(_("Orders"), default=0)
+    quantity = models.IntegerField(_("Quantity"), default=0)
+    revenue = fields.MoneyField(_("Revenue"), default=Decimal("0"))
+    discount_total = fields.MoneyField(_("Discount total"),
+                                       default=Decimal("0"))
+
+    objects = managers.SalesSummaryManager()
+
+    class Meta:
+        verbose_name = _("Sales summary")
+        verbose_name_plural = _("Sales summaries")
+        unique_together = ("date", "dimension", "key")
+        ordering = ("-date", "dimension", "-revenue")
+
+
 class Discount(models.Model):
     """
     Abstract model representing one of several types of monetary
@@ -625,6 +950,8 @@ class Discount(models.Model):
     discount_exact = fields.MoneyField(_("Reduce to amount"))
     valid_from = models.DateTimeField(_("Valid from"), blank=True, null=True)
     valid_to = models.DateTimeField(_("Valid to"), blank=True, null=True)
+    eligible_products = models.ManyToManyField("Product", editable=False,
+                                        related_name="%(class)s_eligible")
 
     class Meta:
         abstract = True
@@ -635,11 +962,37 @@ class Discount(models.Model):
     def all_products(self):
         """
         Return the selected products as well as the products in the
-        selected categories.
+        selected categories, as stored in ``eligible_products``.
         """
-        filters = [category.filters() for category in self.categories.all()]
-        filters = reduce(ior, filters + [Q(id__in=self.products.only("id"))])
-        return Product.objects.filter(filters).distinct()
+        return self.eligible_products.all()
+
+    def refresh_products(self):
+        """
+        Bring ``eligible_products`` in line with the selected products
+        and the products indexed for the selected categories. Called
+        as these are changed, and returns the IDs of the products
+        added and removed.
+        """
+        through = self.eligible_products.through
+        lookup = {"%s_id" % self._meta.object_name.lower(): self.id}
+        categories = list(self.categories.values_list("id", flat=True))
+        indexed = CategoryProduct.objects.filter(category__in=categories)
+        matched = set(self.products.values_list("id", flat=True))
+        matched.update(indexed.values_list("product_id", flat=True))
+        stored = through.objects.filter(**lookup)
+        stored = set(stored.values_list("product_id", flat=True))
+        removed = list(stored - matched)
+        added = list(matched - stored)
+        batch_size = managers.BULK_BATCH_SIZE
+        for i in range(0, len(removed), batch_size):
+            batch = removed[i:i + batch_size]
+            through.objects.filter(product__in=batch, **lookup).delete()
+        for i in range(0, len(added), batch_size):
+            batch = added[i:i + batch_size]
+            through.objects.bulk_create([through(product_id=product_id,
+                                                 **lookup)
+                                         for product_id in batch])
+        return added, removed
 
 
 class Sale(Discount):
@@ -649,6 +1002,8 @@ class Sale(Discount):
     selected categories and products for the sale.
     """
 
+    update_progress = models.IntegerField(null=True, editable=False)
+
     class Meta:
         verbose_name = _("Sale")
         verbose_name_plural = _("Sales")
@@ -659,54 +1014,166 @@ class Sale(Discount):
         to the selected categories and products for the sale.
         """
         super(Sale, self).save(*args, **kwargs)
-        self._clear()
-        if self.active:
-            extra_filter = {}
-            if self.discount_deduct is not None:
-                # Don't apply to prices that would be negative
-                # after deduction.
-                extra_filter["unit_price__gt"] = self.discount_deduct
-                sale_price = models.F("unit_price") - self.discount_deduct
-            elif self.discount_percent is not None:
-                sale_price = models.F("unit_price") - (
-                    models.F("unit_price") / "100.0" * self.discount_percent)
-            elif self.discount_exact is not None:
-                # Don't apply to prices that are cheaper than the sale
-                # amount.
-                extra_filter["unit_price__gt"] = self.discount_exact
-                sale_price = self.discount_exact
-            else:
-                return
-            products = self.all_products()
-            variations = ProductVariation.objects.filter(product__in=products)
-            for priced_objects in (products, variations):
-                # MySQL will raise a 'Data truncated' warning here in
-                # some scenarios, presumably when doing a calculation
-                # that exceeds the precision of the price column. In
-                # this case it's safe to ignore it and the calculation
-                # will still be applied.
-                try:
-                    update = {"sale_id": self.id,
-                              "sale_price": sale_price,
-                              "sale_to": self.valid_to,
-                              "sale_from": self.valid_from}
-                    priced_objects.filter(**extra_filter).update(**update)
-                except OperationalError:
-                    # Work around for MySQL which does not allow update
-                    # to operate on subquery where the FROM clause would
-                    # have it operate on the same table.
-                    #
-                    # http://dev.mysql.com/
-                    # doc/refman/5.0/en/subquery-errors.html
-                    for priced in priced_objects.filter(**extra_filter):
-                        for field, value in update.items():
-                            setattr(priced, field, value)
-                        try:
-                            priced.save()
-                        except Warning:
-                            pass
-                except Warning:
-                    pass
+        self._update()
+
+    def refresh_products(self):
+        """
+        Apply the sale to products that have become eligible for it,
+        and clear it from products that no longer are.
+        """
+        added, removed = super(Sale, self).refresh_products()
+        if added or removed:
+            self._update()
+        return added, removed
+
+    def _update(self):
+        """
+        Update the products and variations for the sale, or when
+        ``SHOP_SALE_BACKGROUND_UPDATE`` is ``True``, flag the sale for
+        the ``apply_sales`` management command to update them.
+        """
+        if settings.SHOP_SALE_BACKGROUND_UPDATE:
+            self.update_progress = 0
+            Sale.objects.filter(id=self.id).update(update_progress=0)
+        else:
+            self.update_products()
+
+    def update_progress_display(self):
+        """
+        Shows how far through updating its products the sale is, for
+        the sale listing view of the admin.
+        """
+        if self.update_progress is None:
+            return ugettext("Applied")
+        return ugettext("Applying: %s%%") % self.update_progress
+    update_progress_display.short_description = _("Products")
+
+    def _sale_fields(self):
+        """
+        Returns the filter for the prices the sale can be applied to
+        and the sale field values to apply, or ``None`` if the sale
+        doesn't reduce prices.
+        """
+        extra_filter = {}
+        if self.discount_deduct is not None:
+            # Don't apply to prices that would be negative
+            # after deduction.
+            extra_filter["unit_price__gt"] = self.discount_deduct
+            sale_price = models.F("unit_price") - self.discount_deduct
+        elif self.discount_percent is not None:
+            sale_price = models.F("unit_price") - (
+                models.F("unit_price") / "100.0" * self.discount_percent)
+        elif self.discount_exact is not None:
+            # Don't apply to prices that are cheaper than the sale
+            # amount.
+            extra_filter["unit_price__gt"] = self.discount_exact
+            sale_price = self.discount_exact
+        else:
+            return None
+        update = {"sale_id": self.id,
+                  "sale_price": sale_price,
+                  "sale_to": self.valid_to,
+                  "sale_from": self.valid_from}
+        return extra_filter, update
+
+    def _sale_price(self, unit_price):
+        """
+        Returns the sale price for the given unit price, matching the
+        price calculated in the database by ``_sale_fields``.
+        """
+        if unit_price is None:
+            return None
+        if self.discount_deduct is not None:
+            return unit_price - Decimal(self.discount_deduct)
+        elif self.discount_percent is not None:
+            percent = Decimal(self.discount_percent)
+            return unit_price - unit_price / Decimal("100.0") * percent
+        return Decimal(self.discount_exact)
+
+    def update_products(self, chunk_size=managers.BULK_BATCH_SIZE):
+        """
+        Brings the sale fields of products and variations in line with
+        the sale, writing only the rows that change. Rows are checked
+        in chunks ordered by ID, each in its own transaction, with the
+        progress stored in ``update_progress``. Since rows that are
+        already up to date are skipped, an interrupted update is
+        resumed by calling this again. Returns the number of rows
+        written.
+        """
+        sale_fields = self._sale_fields() if self.active else None
+        eligible = self.eligible_products.values_list("id", flat=True)
+        chunks = []
+        for priced_model, lookup in ((Product, "id__in"),
+                                     (ProductVariation, "product__in")):
+            current = priced_model.objects.filter(sale_id=self.id)
+            ids = set(current.values_list("id", flat=True))
+            applied = set()
+            if sale_fields is not None:
+                extra_filter, update = sale_fields
+                applied = priced_model.objects.filter(**{lookup: eligible})
+                applied = applied.filter(**extra_filter)
+                applied = set(applied.values_list("id", flat=True))
+                ids |= applied
+            ids = sorted(ids)
+            for i in range(0, len(ids), chunk_size):
+                chunks.append((priced_model, ids[i:i + chunk_size], applied))
+        written = 0
+        for i, (priced_model, ids, applied) in enumerate(chunks):
+            written += self._update_chunk(priced_model, ids, applied,
+                                          sale_fields)
+            self.update_progress = 100 * (i + 1) // len(chunks)
+            Sale.objects.filter(id=self.id).update(
+                update_progress=self.update_progress)
+        self.update_progress = None
+        Sale.objects.filter(id=self.id).update(update_progress=None)
+        if written:
+            self._refresh_categories()
+        return written
+
+    @transaction.commit_on_success
+    def _update_chunk(self, priced_model, ids, applied, sale_fields):
+        """
+        Applies the sale to the products or variations with the given
+        IDs that are in ``applied`` and don't already have it applied,
+        and clears it from the rest. Returns the number of rows written.
+        """
+        field = priced_model._meta.get_field("sale_price")
+        tolerance = Decimal(10) ** -field.decimal_places
+        rows = priced_model.objects.filter(id__in=ids).values_list("id",
+            "unit_price", "sale_id", "sale_price", "sale_from", "sale_to")
+        stale, cleared = [], []
+        for (id, unit_price, sale_id, sale_price,
+             sale_from, sale_to) in rows:
+            if id in applied:
+                price = self._sale_price(unit_price)
+                if (sale_id != self.id or sale_from != self.valid_from or
+                    sale_to != self.valid_to or
+                    (sale_price is None) != (price is None) or
+                    (price is not None and
+                     abs(sale_price - price) >= tolerance)):
+                    stale.append(id)
+            elif sale_id == self.id:
+                cleared.append(id)
+        updates = [(cleared, {"sale_id": None, "sale_price": None,
+                              "sale_from": None, "sale_to": None,
+                              "effective_price": models.F("unit_price")})]
+        if sale_fields is not None:
+            updates.append((stale, sale_fields[1]))
+        for ids, update in updates:
+            if not ids:
+                continue
+            # MySQL will raise a 'Data truncated' warning here in
+            # some scenarios, presumably when doing a calculation
+            # that exceeds the precision of the price column. In
+            # this case it's safe to ignore it and the calculation
+            # will still be applied.
+            try:
+                priced_model.objects.filter(id__in=ids).update(**update)
+            except Warning:
+                pass
+        if stale and sale_fields is not None:
+            priced_model.update_effective_prices(stale)
+        return len(stale) + len(cleared)
 
     def delete(self, *args, **kwargs):
         """
@@ -714,6 +1181,7 @@ class Sale(Discount):
         """
         self._clear()
         super(Sale, self).delete(*args, **kwargs)
+        self._refresh_categories()
 
     def _clear(self):
         """
@@ -721,10 +1189,26 @@ class Sale(Discount):
         to updating the sale, when deactivating it or deleting it.
         """
         update = {"sale_id": None, "sale_price": None,
-                  "sale_from": None, "sale_to": None}
+                  "sale_from": None, "sale_to": None,
+                  "effective_price": models.F("unit_price")}
         for priced_model in (Product, ProductVariation):
             priced_model.objects.filter(sale_id=self.id).update(**update)
 
+    def _refresh_categories(self):
+        """
+        Sale prices are applied with queryset updates which don't
+        trigger the signals that maintain ``CategoryProduct`` and the
+        cached product details, so refresh the categories that filter
+        by this sale or by price, and clear the cached details.
+        """
+        Product.objects.clear_cached()
+        categories = Category.objects.filter(Q(sale=self) |
+                                             Q(price_min__isnull=False) |
+                                             Q(price_max__isnull=False))
+        CategoryProduct.objects.refresh(categories=categories)
+        CategoryProduct.objects.schedule_sale_boundaries(self.valid_from,
+                                                         self.valid_to)
+
 
 class DiscountCode(Discount):
     """
@@ -754,3 +1238,140 @@ class DiscountCode(Discount):
     class Meta:
         verbose_name = _("Discount code")
         verbose_name_plural = _("Discount codes")
+
+
+def update_category_index(sender, instance, **kwargs):
+    """
+    Refresh ``CategoryProduct`` entries for the product or category
+    being saved or deleted.
+    """
+    if kwargs.get("raw") or not CategoryProduct.objects.auto_refresh:
+        return
+    if isinstance(instance, Category):
+        CategoryProduct.objects.refresh(categories=[instance])
+    else:
+        product_id = getattr(instance, "product_id", instance.id)
+        CategoryProduct.objects.refresh(products=[product_id])
+        CategoryProduct.objects.schedule_sale_boundaries(instance.sale_from,
+                                                         instance.sale_to)
+
+
+def update_category_index_m2m(sender, instance, action, pk_set, **kwargs):
+    """
+    Refresh ``CategoryProduct`` entries when products or options are
+    assigned to categories.
+    """
+    if (not action.startswith("post_") or
+        not CategoryProduct.objects.auto_refresh):
+        return
+    if sender is Category.options.through:
+        categories = [instance] if isinstance(instance, Category) else pk_set
+        CategoryProduct.objects.refresh(categories=categories)
+    elif isinstance(instance, Category):
+        CategoryProduct.objects.refresh(categories=[instance],
+                                        products=pk_set)
+    else:
+        CategoryProduct.objects.refresh(categories=pk_set,
+                                        products=[instance.id])
+
+
+def update_discount_products(sender, instance, action, pk_set, **kwargs):
+    """
+    Refresh the eligible products for discounts when their products or
+    categories are changed, from either side of the relationship.
+    """
+    if not action.startswith("post_"):
+        return
+    if isinstance(instance, Discount):
+        discounts = [instance]
+    else:
+        discounts = kwargs["model"].objects.all()
+        if pk_set is not None:
+            discounts = discounts.filter(id__in=pk_set)
+    for discount in discounts:
+        discount.refresh_products()
+
+
+def clear_product_cache(sender, instance, **kwargs):
+    """
+    Remove the cached details for the product being saved or deleted,
+    or for the product of the variation or image, along with products
+    that show the product as related.
+    """
+    if isinstance(instance, Product):
+        if kwargs["signal"] is post_delete:
+            # Its relationships are already deleted, so the products
+            # it was related to aren't known.
+            Product.objects.clear_cached()
+            return
+        product_ids = list(instance.related_products.values_list("id",
+                                                                 flat=True))
+        product_ids.append(instance.id)
+    else:
+        product_ids = [instance.product_id]
+    Product.objects.clear_cached(product_ids)
+
+
+def clear_category_counts(sender, instance, **kwargs):
+    """
+    Remove the number of products cached for each category when a
+    product is saved or deleted, as it may have been published or
+    unpublished.
+    """
+    CategoryProduct.objects.clear_counts()
+
+
+def clear_product_cache_m2m(sender, instance, action, pk_set, **kwargs):
+    """
+    Remove the cached details for products when related products are
+    assigned to them.
+    """
+    if not action.startswith("post_"):
+        return
+    if pk_set is None:
+        Product.objects.clear_cached()
+    else:
+        Product.objects.clear_cached(list(pk_set) + [instance.id])
+
+
+def release_cart_item(sender, instance, **kwargs):
+    """
+    Remove the quantity of a deleted cart item from the variation's
+    ``num_in_carts``, including items deleted with their cart, and
+    from the cart's totals.
+    """
+    if instance._saved_quantity:
+        ProductVariation.objects.reserve(instance.sku,
+                                         -instance._saved_quantity)
+    Cart.objects.filter(id=instance.cart_id).update(
+        item_count=models.F("item_count") - 1,
+        item_quantity=models.F("item_quantity") - instance._saved_quantity,
+        item_total=models.F("item_total") - instance._saved_total)
+
+
+def flush_product_actions(sender, **kwargs):
+    """
+    Write the product action counts buffered by the process once the
+    response has been sent, if they're due to be written.
+    """
+    ProductAction.objects.flush(due_only=True)
+
+
+post_delete.connect(release_cart_item, sender=CartItem)
+for sender in (Category, Product, ProductVariation):
+    post_save.connect(update_category_index, sender=sender)
+post_delete.connect(update_category_index, sender=ProductVariation)
+for sender in (Product, ProductVariation, ProductImage):
+    post_save.connect(clear_product_cache, sender=sender)
+    post_delete.connect(clear_product_cache, sender=sender)
+post_save.connect(clear_category_counts, sender=Product)
+post_delete.connect(clear_category_counts, sender=Product)
+m2m_changed.connect(clear_product_cache_m2m,
+                    sender=Product.related_products.through)
+for sender in (Product.categories.through, Category.options.through):
+    m2m_changed.connect(update_category_index_m2m, sender=sender)
+for discount_model in (Sale, DiscountCode):
+    for sender in (discount_model.products.through,
+                   discount_model.categories.through):
+        m2m_changed.connect(update_discount_products, sender=sender)
+request_finished.connect(flush_product_actions)
@@ -3,9 +3,11 @@ from django.template.defaultfilters import slugify
 
 from mezzanine.conf import settings
 from mezzanine.pages.page_processors import processor_for
+from mezzanine.utils.cache import cache_get, cache_set
 from mezzanine.utils.views import paginate
 
-from cartridge.shop.models import Category, Product
+from cartridge.shop.models import Category, CategoryProduct, Product
+from cartridge.shop.utils import paginate_keyset
 
 
 @processor_for(Category)
@@ -14,14 +16,36 @@ def category_processor(request, page):
     Add paging/sorting to the products for the category.
     """
     settings.use_editable()
-    products = Product.objects.published(for_user=request.user
-                                ).filter(page.category.filters()).distinct()
+    CategoryProduct.objects.update_sales()
+    products = Product.objects.published(for_user=request.user)
+    products = products.filter(category_index__category=page.category)
     sort_options = [(slugify(option[0]), option[1])
                     for option in settings.SHOP_PRODUCT_SORT_OPTIONS]
     sort_by = request.GET.get("sort", sort_options[0][1])
-    products = paginate(products.order_by(sort_by),
-                        request.GET.get("page", 1),
-                        settings.SHOP_PER_PAGE_CATEGORY,
-                        settings.MAX_PAGING_LINKS)
+    if settings.SHOP_CATEGORY_KEYSET_PAGING:
+        # Only sort by the configured fields, since the sort field is
+        # used to seek to the page, and cache the total count since
+        # it's only used for display, until products are changed.
+        if sort_by not in [option[1] for option in sort_options]:
+            sort_by = sort_options[0][1]
+        version = CategoryProduct.objects.count_version()
+        cache_key = "shop-category-count.%s.%s.%s" % (version, page.id,
+                                                      request.user.is_staff)
+        count = cache_get(cache_key)
+        if count is None:
+            count = products.count()
+            cache_set(cache_key, count)
+        products = paginate_keyset(products, sort_by, request.GET,
+                                   settings.SHOP_PER_PAGE_CATEGORY, count)
+        query = request.GET.copy()
+        for name in ("page", "after", "before"):
+            if name in query:
+                del query[name]
+        products.querystring = query.urlencode()
+    else:
+        products = paginate(products.order_by(sort_by),
+                            request.GET.get("page", 1),
+                            settings.SHOP_PER_PAGE_CATEGORY,
+                            settings.MAX_PAGING_LINKS)
     products.sort_by = sort_by
     return {"products": products}
@@ -1,11 +1,22 @@
 
-from datetime import timedelta
+from __future__ import with_statement
+import csv
+import os
+import sys
+from cStringIO import StringIO
+from datetime import date, timedelta
 from decimal import Decimal
 from operator import mul
+from tempfile import mkstemp
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
 from mezzanine.conf import settings
+from mezzanine.core.models import CONTENT_STATUS_DRAFT
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 from mezzanine.utils.tests import run_pyflakes_for_package
 from mezzanine.utils.tests import run_pep8_for_package
@@ -13,8 +24,14 @@ from mezzanine.utils.timezone import now
 
 from cartridge.shop.models import Product, ProductOption, ProductVariation
 from cartridge.shop.models import Category, Cart, Order, DiscountCode
-from cartridge.shop.models import Sale
+from cartridge.shop.models import Sale, CategoryProduct, ProductAction
+from cartridge.shop.models import SalesSummary
+from cartridge.shop.managers import SALE_BOUNDARIES_CACHE_KEY
+from cartridge.shop import views
 from cartridge.shop.checkout import CHECKOUT_STEPS
+from cartridge.shop.forms import AddProductForm
+from cartridge.shop.management.commands import product_db
+from cartridge.shop.utils import paginate_keyset, seek
 
 
 TEST_STOCK = 5
@@ -35,6 +52,9 @@ class ShopTests(TestCase):
                 name = "test%s" % i
                 ProductOption.objects.create(type=option_type[0], name=name)
         self._options = ProductOption.objects.as_fields()
+        # IDs are reused once each test is rolled back, so remove any
+        # product details cached by previous tests.
+        Product.objects.clear_cached()
 
     def test_views(self):
         """
@@ -53,6 +73,8 @@ class ShopTests(TestCase):
         response = self.client.get(reverse("shop_checkout"))
         self.assertEqual(response.status_code, 200 if not
             settings.SHOP_CHECKOUT_ACCOUNT_REQUIRED else 302)
+        # Carts are only stored once an item is added.
+        self.assertEqual(Cart.objects.count(), 0)
 
     def test_variations(self):
         """
@@ -94,6 +116,66 @@ class ShopTests(TestCase):
         variation.num_in_stock = 0
         self.assertFalse(variation.has_stock())
 
+    def test_product_cache(self):
+        """
+        Test the details shown on product pages are cached until the
+        product or its variations are changed, with only their stock
+        levels and prices retrieved, so that prices changed without
+        clearing the cache, as in other processes, are still current.
+        """
+        seconds = settings.SHOP_PRODUCT_CACHE_SECONDS
+        settings.SHOP_PRODUCT_CACHE_SECONDS = 60
+        try:
+            self._product.variations.manage_empty()
+            slug = self._product.slug
+            details = Product.objects.details(slug)
+            self.assertEqual(details["options"], [])
+            self.assertNumQueries(1, Product.objects.details, slug)
+            variation = self._product.variations.all()[0]
+            variation.unit_price = TEST_PRICE
+            variation.save()
+            details = Product.objects.details(slug)
+            self.assertEqual(details["variations"][0].price(), TEST_PRICE)
+            self.assertNumQueries(1, Product.objects.details, slug)
+            variations = ProductVariation.objects.filter(id=variation.id)
+            variations.update(unit_price=TEST_PRICE * 2,
+                              effective_price=TEST_PRICE * 2)
+            details = Product.objects.details(slug)
+            self.assertEqual(details["variations"][0].price(), TEST_PRICE * 2)
+            self._product.expiry_date = now() - timedelta(days=1)
+            self._product.save()
+            self.assertRaises(Product.DoesNotExist,
+                              Product.objects.details, slug)
+        finally:
+            settings.SHOP_PRODUCT_CACHE_SECONDS = seconds
+
+    def test_add_product_form(self):
+        """
+        Test the variation chosen is found among the variations given
+        to the form, and only read again when adding it to the cart,
+        so that its current price is added.
+        """
+        self._product.variations.create_from_options(self._options)
+        self._product.variations.update(unit_price=TEST_PRICE,
+                                        effective_price=TEST_PRICE,
+                                        num_in_stock=TEST_STOCK)
+        variations = list(self._product.variations.all())
+        variation = variations[-1]
+        self._product.variations.update(effective_price=TEST_PRICE * 2)
+        field_names = [f.name for f in ProductVariation.option_fields()]
+        data = dict(zip(field_names, variation.options()))
+        kwargs = {"product": self._product, "variations": variations}
+        for quantity, valid in ((TEST_STOCK, True), (TEST_STOCK + 1, False)):
+            data["quantity"] = quantity
+            form = AddProductForm(data, to_cart=True, **kwargs)
+            self.assertNumQueries(1, form.is_valid)
+            self.assertEqual(form.is_valid(), valid)
+            if valid:
+                self.assertEqual(form.variation, variation)
+                self.assertEqual(form.variation.price(), TEST_PRICE * 2)
+        form = AddProductForm(data, to_cart=False, **kwargs)
+        self.assertNumQueries(0, form.is_valid)
+
     def assertCategoryFilteredProducts(self, num_products):
         """
         Tests the number of products returned by the category's
@@ -129,20 +211,26 @@ class ShopTests(TestCase):
         # with previously created filters, should match no products.
         # Update the variations to match the filter for a unit price,
         # then with sale prices, checking correct matches based on sale
-        # dates.
+        # dates once the effective prices are updated.
         self._category.combined = True
         self._category.price_min = TEST_PRICE
         self.assertCategoryFilteredProducts(0)
         self._product.variations.all().update(unit_price=TEST_PRICE)
+        ProductVariation.update_effective_prices()
         self.assertCategoryFilteredProducts(1)
         n, d = now(), timedelta(days=1)
         tomorrow, yesterday = n + d, n - d
         self._product.variations.all().update(unit_price=0,
                                               sale_price=TEST_PRICE,
                                               sale_from=tomorrow)
+        ProductVariation.update_effective_prices()
         self.assertCategoryFilteredProducts(0)
         self._product.variations.all().update(sale_from=yesterday)
+        ProductVariation.update_effective_prices()
         self.assertCategoryFilteredProducts(1)
+        variation = self._product.variations.all()[0]
+        self.assertTrue(variation.on_sale())
+        self.assertEqual(variation.price(), TEST_PRICE)
 
         # Clean up previously added filters and check that explicitly
         # assigned products match.
@@ -175,6 +263,149 @@ class ShopTests(TestCase):
         self._category.combined = False
         self.assertCategoryFilteredProducts(1)
 
+    def assertCategoryIndexedProducts(self, num_products):
+        """
+        Tests the number of products stored for the category in the
+        ``CategoryProduct`` index.
+        """
+        self.assertEqual(self._category.product_index.count(), num_products)
+
+    def test_category_index(self):
+        """
+        Test the stored products for a category are updated as
+        products, variations and the category's filters change.
+        """
+        self._product.variations.all().delete()
+        self.assertCategoryIndexedProducts(0)
+
+        # Explicitly assigned products.
+        self._category.products.add(self._product)
+        self.assertCategoryIndexedProducts(1)
+        self._product.categories.remove(self._category)
+        self.assertCategoryIndexedProducts(0)
+
+        # Option filters - the index should follow both the category's
+        # options and the options of variations being created.
+        option_field, options = self._options.items()[0]
+        option = ProductOption.objects.get(type=option_field[-1],
+                                           name=options[0])
+        self._category.options.add(option)
+        self.assertCategoryIndexedProducts(0)
+        self._product.variations.create_from_options({option_field:
+                                                     [options[0]]})
+        self.assertCategoryIndexedProducts(1)
+
+        # Price filters - saving the category or a variation should
+        # refresh the index.
+        self._category.price_min = TEST_PRICE
+        self._category.save()
+        self.assertCategoryIndexedProducts(0)
+        variation = self._product.variations.all()[0]
+        variation.unit_price = TEST_PRICE
+        variation.save()
+        self.assertCategoryIndexedProducts(1)
+        variation.delete()
+        self.assertCategoryIndexedProducts(0)
+
+    def test_category_index_sales(self):
+        """
+        Test the stored products for a category filtering by price are
+        refreshed when a sale starts and ends, and that the next sale
+        boundary is known.
+        """
+        self._product.variations.all().delete()
+        self._product.variations.manage_empty()
+        self._category.price_min = TEST_PRICE
+        self._category.save()
+        cache.delete(SALE_BOUNDARIES_CACHE_KEY)
+        CategoryProduct.objects.update_sales()
+        self.assertCategoryIndexedProducts(0)
+        # Start a sale without saving the variation, as occurs when
+        # the sale date passes.
+        n, d = now(), timedelta(days=1)
+        self._product.variations.all().update(unit_price=0,
+                                              sale_price=TEST_PRICE,
+                                              sale_from=n, sale_to=n + d)
+        self.assertCategoryIndexedProducts(0)
+        boundary = CategoryProduct.objects.update_sales(force=True)
+        self.assertCategoryIndexedProducts(1)
+        self.assertEqual(boundary, n + d)
+        # End the sale after the state has expired, which is picked up
+        # from the products whose effective price is out of date.
+        self._product.variations.all().update(sale_to=n)
+        cache.delete(SALE_BOUNDARIES_CACHE_KEY)
+        CategoryProduct.objects.update_sales()
+        self.assertCategoryIndexedProducts(0)
+        # Prices are also brought up to date when a boundary passes
+        # before the product, cart or checkout pages are viewed.
+        self._product.variations.all().update(sale_to=n + d)
+        cache.delete(SALE_BOUNDARIES_CACHE_KEY)
+        CategoryProduct.objects.update_sales()
+        self.assertCategoryIndexedProducts(1)
+        self._product.variations.all().update(sale_to=n)
+        cache.set(SALE_BOUNDARIES_CACHE_KEY, {"checked": n, "next": n})
+        self.client.get(self._product.get_absolute_url())
+        variation = self._product.variations.all()[0]
+        self.assertEqual(variation.price(), 0)
+        self.assertCategoryIndexedProducts(0)
+
+    def test_keyset_paging(self):
+        """
+        Test paging through products by seeking from the last product
+        of each page returns every product once in order, with nulls
+        last, and that paging backwards returns the same pages.
+        """
+        Product.objects.all().delete()
+        prices = [3, 1, None, 2, 1, None, 3]
+        for price in prices:
+            Product.objects.create(unit_price=price, **self._published)
+        products = Product.objects.all()
+        for sort_by in ("unit_price", "-unit_price"):
+            priced = products.filter(unit_price__isnull=False)
+            key = lambda p: (p.unit_price, p.id)
+            expected = sorted(priced, key=key, reverse=sort_by[0] == "-")
+            expected += sorted(products.filter(unit_price__isnull=True),
+                               key=lambda p: p.id, reverse=sort_by[0] == "-")
+            expected = [p.id for p in expected]
+            self.assertEqual([p.id for p in seek(products, sort_by)],
+                             expected)
+            pages = []
+            query = {}
+            while True:
+                page = paginate_keyset(products, sort_by, query, 2,
+                                       len(prices))
+                pages.append([p.id for p in page])
+                if not page.has_next():
+                    break
+                query = {"after": page.last_id()}
+            self.assertEqual(reduce(list.__add__, pages), expected)
+            for previous in reversed(pages[:-1]):
+                query = {"before": page.first_id()}
+                page = paginate_keyset(products, sort_by, query, 2,
+                                       len(prices))
+                self.assertEqual([p.id for p in page], previous)
+            self.assertFalse(page.has_previous())
+            # Invalid IDs fall back to the first page.
+            for query in ({"after": "abc"}, {"before": "1x"}):
+                page = paginate_keyset(products, sort_by, query, 2,
+                                       len(prices))
+                self.assertEqual([p.id for p in page], pages[0])
+        # The number of products cached for the category's pages is
+        # removed once a product is unpublished.
+        settings.SHOP_CATEGORY_KEYSET_PAGING = True
+        try:
+            self._category.products.add(*products)
+            url = self._category.get_absolute_url()
+            count = lambda: self.client.get(url).context[
+                "products"].paginator.count
+            self.assertEqual(count(), len(prices))
+            product = products[0]
+            product.status = CONTENT_STATUS_DRAFT
+            product.save()
+            self.assertEqual(count(), len(prices) - 1)
+        finally:
+            settings.SHOP_CATEGORY_KEYSET_PAGING = False
+
     def _add_to_cart(self, variation, quantity):
         """
         Given a variation, creates the dict for posting to the cart
@@ -238,19 +469,91 @@ class ShopTests(TestCase):
         cart = Cart.objects.from_request(self.client)
         variation = self._product.variations.all()[0]
         self.assertFalse(variation.has_stock())
+        self.assertEqual(variation.num_in_carts, TEST_STOCK * 2)
+        self.assertEqual(variation.live_num_in_stock(), 0)
         self.assertTrue(cart.has_items())
+        self.assertEqual(cart.item_count, 1)
         self.assertEqual(cart.total_quantity(), TEST_STOCK * 2)
         self.assertEqual(cart.total_price(), TEST_PRICE * TEST_STOCK * 2)
 
+        # Drifted quantities in carts are corrected when rebuilt.
+        ProductVariation.objects.filter(id=variation.id).update(
+            num_in_carts=0)
+        self.assertEqual(ProductVariation.objects.rebuild_num_in_carts(), 1)
+        variation = self._product.variations.all()[0]
+        self.assertEqual(variation.num_in_carts, TEST_STOCK * 2)
+
         # Remove from cart.
         self._empty_cart(cart)
         cart = Cart.objects.from_request(self.client)
         variation = self._product.variations.all()[0]
         self.assertTrue(variation.has_stock(TEST_STOCK * 2))
+        self.assertEqual(variation.num_in_carts, 0)
         self.assertFalse(cart.has_items())
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(cart.total_price(), Decimal("0"))
 
+    def test_cart_touch(self):
+        """
+        Test that the cart's last updated time is only saved once it's
+        behind by the touch fraction of the cart expiry.
+        """
+        self._reset_variations()
+        self._add_to_cart(self._product.variations.all()[0], 1)
+        cart = Cart.objects.from_request(self.client)
+        touch_minutes = (settings.SHOP_CART_EXPIRY_MINUTES *
+                         settings.SHOP_CART_TOUCH_FRACTION)
+        for minutes, touched in ((touch_minutes / 2, False),
+                                 (touch_minutes * 2, True)):
+            last_updated = now() - timedelta(minutes=minutes)
+            Cart.objects.filter(id=cart.id).update(last_updated=last_updated)
+            Cart.objects.from_request(self.client)
+            cart = Cart.objects.get(id=cart.id)
+            self.assertEqual(cart.last_updated > last_updated, touched)
+
+    def test_session_cart(self):
+        """
+        Test that carts for anonymous users are kept in the session
+        when ``SHOP_CART_SESSION_STORAGE`` is set, and stored with
+        their stock held once the cart page is viewed.
+        """
+        settings.SHOP_CART_SESSION_STORAGE = True
+        try:
+            self._reset_variations()
+            variation = self._product.variations.all()[0]
+            self._add_to_cart(variation, 1)
+            self._add_to_cart(variation, 1)
+            self.assertEqual(Cart.objects.count(), 0)
+            cart = Cart.objects.from_request(self.client)
+            self.assertEqual(cart.total_quantity(), 2)
+            self.assertEqual(cart.total_price(), TEST_PRICE * 2)
+            self.assertEqual(cart.skus(), [variation.sku])
+            self.client.get(reverse("shop_cart"))
+            self.assertEqual(Cart.objects.count(), 1)
+            cart = Cart.objects.from_request(self.client)
+            self.assertEqual(cart.items.get().quantity, 2)
+            variation = self._product.variations.all()[0]
+            self.assertEqual(variation.num_in_carts, 2)
+        finally:
+            del settings.SHOP_CART_SESSION_STORAGE
+
+    def test_delete_expired_carts(self):
+        """
+        Test that only expired carts are deleted, releasing their
+        items' quantities from stock held in carts.
+        """
+        self._reset_variations()
+        variation = self._product.variations.all()[0]
+        self._add_to_cart(variation, 1)
+        expired = Cart.objects.create(last_updated=Cart.objects.expiry_time())
+        expired.add_item(variation, 1)
+        Cart.objects.filter(id=expired.id).update(
+            last_updated=expired.last_updated - timedelta(minutes=1))
+        self.assertEqual(Cart.objects.delete_expired(batch_size=1), 1)
+        self.assertEqual(Cart.objects.count(), 1)
+        variation = self._product.variations.all()[0]
+        self.assertEqual(variation.num_in_carts, 1)
+
     def test_discount_codes(self):
         """
         Test that all types of discount codes are applied.
@@ -295,6 +598,13 @@ class ShopTests(TestCase):
                 elif discount_type == "deduct":
                     expected = discount_value
                 self.assertEqual(discount_total, expected)
+                # Only the product specific discount has eligible skus.
+                cart = Cart.objects.from_request(self.client)
+                discount_skus = cart.discount_skus(discount)
+                if discount_target == "cart":
+                    self.assertEqual(discount_skus, None)
+                else:
+                    self.assertEqual(discount_skus, set([variation.sku]))
                 if discount_target == "item":
                     # Test discount isn't applied for an invalid product.
                     cart = Cart.objects.from_request(self.client)
@@ -304,6 +614,21 @@ class ShopTests(TestCase):
                     discount_total = self.client.session.get("discount_total")
                     self.assertEqual(discount_total, None)
 
+    def test_discount_eligible_products(self):
+        """
+        Test that the products stored for a discount follow its
+        selected products and the products in its categories.
+        """
+        discount = DiscountCode.objects.create(code="eligible", active=True)
+        discount.categories.add(self._category)
+        self.assertEqual(list(discount.all_products()), [])
+        self._product.categories.add(self._category)
+        self.assertEqual(list(discount.all_products()), [self._product])
+        self._product.categories.remove(self._category)
+        self.assertEqual(list(discount.all_products()), [])
+        discount.products.add(self._product)
+        self.assertEqual(list(discount.all_products()), [self._product])
+
     def test_order(self):
         """
         Test that a completed order contains cart items and that
@@ -312,12 +637,36 @@ class ShopTests(TestCase):
 
         # Add to cart.
         self._reset_variations()
+        self._product.categories.add(self._category)
         variation = self._product.variations.all()[0]
         self._add_to_cart(variation, TEST_STOCK)
-        cart = Cart.objects.from_request(self.client)
 
-        # Post order.
+        # Orders aren't created if stock runs out before payment.
         data = {"step": len(CHECKOUT_STEPS)}
+        variations = ProductVariation.objects.filter(id=variation.id)
+        variations.update(num_in_stock=TEST_STOCK - 1)
+        self.client.post(reverse("shop_checkout"), data)
+        self.assertRaises(Order.DoesNotExist, Order.objects.from_request,
+                          self.client)
+        self.assertEqual(variations[0].num_in_stock, TEST_STOCK - 1)
+        variations.update(num_in_stock=TEST_STOCK * 2)
+
+        # Stock is restored and the order removed if the payment
+        # handler raises an unexpected error.
+        def fail(request, form, order):
+            raise ValueError
+        payment_handler = views.payment_handler
+        views.payment_handler = fail
+        try:
+            self.assertRaises(ValueError, self.client.post,
+                              reverse("shop_checkout"), data)
+        finally:
+            views.payment_handler = payment_handler
+        self.assertRaises(Order.DoesNotExist, Order.objects.from_request,
+                          self.client)
+        self.assertEqual(variations[0].num_in_stock, TEST_STOCK * 2)
+
+        # Post order.
         self.client.post(reverse("shop_checkout"), data)
         try:
             order = Order.objects.from_request(self.client)
@@ -325,6 +674,7 @@ class ShopTests(TestCase):
             self.fail("Couldn't create an order")
         items = order.items.all()
         variation = self._product.variations.all()[0]
+        cart = Cart.objects.from_request(self.client)
 
         self.assertEqual(cart.total_quantity(), 0)
         self.assertEqual(len(items), 1)
@@ -333,13 +683,126 @@ class ShopTests(TestCase):
         self.assertEqual(variation.num_in_stock, TEST_STOCK)
         self.assertEqual(order.item_total, TEST_PRICE * TEST_STOCK)
 
+        # The order is added to the sales summaries once pending
+        # orders are added, and the same summaries are built when
+        # they're rebuilt from the orders, for all dates or its date.
+        fields = ("dimension", "key", "orders", "quantity", "revenue")
+        summaries = lambda: list(SalesSummary.objects.order_by(
+            "dimension", "key").values_list(*fields))
+        self.assertEqual(summaries(), [])
+        self.assertEqual(SalesSummary.objects.rebuild(), 0)
+        self.assertEqual(SalesSummary.objects.add_pending(), 1)
+        self.assertEqual(SalesSummary.objects.add_pending(), 0)
+        added = summaries()
+        self.assertEqual(added, [
+            ("category", unicode(self._category.id), 1, TEST_STOCK,
+             TEST_PRICE * TEST_STOCK),
+            ("sku", variation.sku, 1, TEST_STOCK, TEST_PRICE * TEST_STOCK),
+            ("total", "", 1, TEST_STOCK, order.total),
+        ])
+        self.assertEqual(SalesSummary.objects.rebuild(), 1)
+        self.assertEqual(summaries(), added)
+        day = SalesSummary.objects.all()[0].date
+        self.assertEqual(SalesSummary.objects.rebuild(day, day), 1)
+        self.assertEqual(summaries(), added)
+        day -= timedelta(days=1)
+        self.assertEqual(SalesSummary.objects.rebuild(day, day), 0)
+        self.assertEqual(summaries(), added)
+
+    def test_product_actions(self):
+        """
+        Test that product action counts are buffered until flushed,
+        either once a request finishes after the flush interval or
+        when a flush fails, and are then added to the existing counts.
+        """
+        ProductAction.objects.flush()
+        ProductAction.objects.all().delete()
+        for i in range(3):
+            self._product.actions.added_to_cart()
+        self._product.actions.purchased()
+        self.client.get(reverse("shop_cart"))
+        self.assertEqual(ProductAction.objects.count(), 0)
+        seconds = settings.SHOP_PRODUCT_ACTION_FLUSH_SECONDS
+        settings.SHOP_PRODUCT_ACTION_FLUSH_SECONDS = -1
+        try:
+            self.client.get(reverse("shop_cart"))
+        finally:
+            settings.SHOP_PRODUCT_ACTION_FLUSH_SECONDS = seconds
+        self.assertEqual(self._product.actions.get().total_cart, 3)
+        self._product.actions.added_to_cart()
+
+        def fail(pending):
+            raise ValueError
+        ProductAction.objects._write_counts = fail
+        try:
+            self.assertRaises(ValueError, ProductAction.objects.flush)
+        finally:
+            del ProductAction.objects._write_counts
+        ProductAction.objects.flush()
+        action = self._product.actions.get()
+        self.assertEqual(action.total_cart, 4)
+        self.assertEqual(action.total_purchase, 1)
+
+    def test_popularity(self):
+        """
+        Test that product actions add to the popularity of products,
+        decayed by the days passed since, that each day is only
+        added once it's over, and that counts written late are added.
+        """
+        ProductAction.objects.flush()
+        ProductAction.objects.all().delete()
+        today = date.today().toordinal()
+        half_life = settings.SHOP_POPULARITY_HALF_LIFE
+        for timestamp in (today, today - 1, today - 1 - half_life):
+            ProductAction.objects.create(product=self._product,
+                                         timestamp=timestamp, total_cart=4)
+        self.assertEqual(ProductAction.objects.update_popularity(), 1)
+        self.assertEqual(ProductAction.objects.update_popularity(), 0)
+        product = Product.objects.get(id=self._product.id)
+        self.assertAlmostEqual(product.popularity, 6)
+        self.assertEqual(product.popularity_timestamp, today - 1)
+        # Counts for a day already added, written late by another
+        # process, are added by the next call.
+        late = {(self._product.id, today - 1, "total_cart"): 4}
+        ProductAction.objects._write_counts(late)
+        self.assertEqual(ProductAction.objects.update_popularity(), 1)
+        self.assertEqual(ProductAction.objects.update_popularity(), 0)
+        product = Product.objects.get(id=self._product.id)
+        self.assertAlmostEqual(product.popularity, 10)
+
+    def test_reduce_stock(self):
+        """
+        Test that stock is only reduced for SKUs with enough stock,
+        unless it's clamped to zero.
+        """
+        self._reset_variations()
+        variations = self._product.variations.all()
+        in_stock, unlimited = variations[0], variations[1]
+        quantities = {in_stock.sku: TEST_STOCK, unlimited.sku: TEST_STOCK}
+        for remaining in (TEST_STOCK, 0):
+            failed = ProductVariation.objects.reduce_stock(quantities)
+            self.assertEqual(failed, [])
+            in_stock = ProductVariation.objects.get(id=in_stock.id)
+            self.assertEqual(in_stock.num_in_stock, remaining)
+        failed = ProductVariation.objects.reduce_stock(quantities)
+        self.assertEqual(failed, [in_stock.sku])
+        in_stock = ProductVariation.objects.get(id=in_stock.id)
+        self.assertEqual(in_stock.num_in_stock, 0)
+        # Stock is restored, and set to zero when clamped.
+        ProductVariation.objects.restore_stock({in_stock.sku: 1})
+        failed = ProductVariation.objects.reduce_stock(quantities, clamp=True)
+        self.assertEqual(failed, [in_stock.sku])
+        in_stock = ProductVariation.objects.get(id=in_stock.id)
+        self.assertEqual(in_stock.num_in_stock, 0)
+        unlimited = ProductVariation.objects.get(id=unlimited.id)
+        self.assertEqual(unlimited.num_in_stock, None)
+
     def test_syntax(self):
         """
         Run pyflakes/pep8 across the code base to check for potential errors.
         """
         extra_ignore = (
                 "redefinition of unused 'digest'",
-                "redefinition of unused 'OperationalError'",
                 "'from mezzanine.project_template.settings import *' used",
         )
         warnings = []
@@ -350,6 +813,30 @@ class ShopTests(TestCase):
             self.fail("Syntax warnings!\n\n%s" % "\n".join(warnings))
 
 
+class StockTests(TransactionTestCase):
+
+    def test_reduce_stock_rollback(self):
+        """
+        Test that no stock is reduced when any of the SKUs don't have
+        enough stock, unless it's clamped to zero. Requires real
+        transactions, since the reductions are rolled back.
+        """
+        product = Product.objects.create()
+        stock = {"in-stock": TEST_STOCK, "low-stock": 1}
+        for sku, num_in_stock in stock.items():
+            ProductVariation.objects.create(product=product, sku=sku,
+                                            num_in_stock=num_in_stock)
+        quantities = {"in-stock": TEST_STOCK, "low-stock": TEST_STOCK}
+        current = lambda: dict(ProductVariation.objects.values_list(
+            "sku", "num_in_stock"))
+        failed = ProductVariation.objects.reduce_stock(quantities)
+        self.assertEqual(failed, ["low-stock"])
+        self.assertEqual(current(), stock)
+        failed = ProductVariation.objects.reduce_stock(quantities, clamp=True)
+        self.assertEqual(failed, ["low-stock"])
+        self.assertEqual(current(), {"in-stock": 0, "low-stock": 0})
+
+
 class SaleTests(TestCase):
 
     def setUp(self):
@@ -400,3 +887,247 @@ class SaleTests(TestCase):
             self.assertTrue(product.sale_price)
         for variation in ProductVariation.objects.all():
             self.assertTrue(variation.sale_price)
+
+    def test_sale_update(self):
+        """
+        Test that saving a sale only writes the rows whose sale fields
+        change, and that products removed from the sale are cleared.
+        """
+        sale = Sale.objects.all()[0]
+        sale.active = True
+        sale.save()
+        product1, product2 = Product.objects.all()
+        self.assertEqual(sale.update_products(), 0)
+        variation = ProductVariation.objects.all()[0]
+        ProductVariation.objects.filter(id=variation.id).update(sale_price=0)
+        self.assertEqual(sale.update_products(chunk_size=1), 1)
+        sale.products.remove(product2)
+        self.assertTrue(Product.objects.get(id=product1.id).sale_price)
+        self.assertFalse(Product.objects.get(id=product2.id).sale_price)
+        for variation in product2.variations.all():
+            self.assertFalse(variation.sale_price)
+        sale.active = False
+        sale.save()
+        self.assertFalse(Product.objects.filter(sale_id=sale.id).exists())
+
+    def test_sale_background_update(self):
+        """
+        Test that with ``SHOP_SALE_BACKGROUND_UPDATE`` set, saving a
+        sale leaves its products to be updated by ``apply_sales``.
+        """
+        settings.SHOP_SALE_BACKGROUND_UPDATE = True
+        try:
+            sale = Sale.objects.all()[0]
+            sale.active = True
+            sale.save()
+            self.assertEqual(Sale.objects.get(id=sale.id).update_progress, 0)
+            variations = ProductVariation.objects.filter(sale_id=sale.id)
+            self.assertEqual(variations.count(), 0)
+            call_command("apply_sales", chunk_size=1, verbosity=0)
+            self.assertEqual(Sale.objects.get(id=sale.id).update_progress,
+                             None)
+            self.assertEqual(variations.count(), 4)
+        finally:
+            del settings.SHOP_SALE_BACKGROUND_UPDATE
+
+
+class ProductDBTests(TransactionTestCase):
+    """
+    Round trips through the ``product_db`` command. Imports commit a
+    transaction per chunk, so these require real transactions.
+    """
+
+    def setUp(self):
+        """
+        Set up the rows for a product with two sizes, one on sale, and
+        a product without options and with unlimited stock.
+        """
+        self._paths = []
+        self._rows = [
+            self._row("Shirt", "shirt-s", size="Small", stock="5",
+                      price="20.00", sale_price="15.00",
+                      sale=("2013-01-01", "09:00", "2013-01-31", "17:00")),
+            self._row("Shirt", "shirt-l", size="Large", stock="3",
+                      price="20.00"),
+            self._row("Hat", "hat", price="10.00"),
+        ]
+
+    def tearDown(self):
+        for path in self._paths:
+            os.remove(path)
+
+    def _row(self, title, sku, size="", stock="", price="", sale_price="",
+             sale=("", "", "", "")):
+        """
+        Returns a csv row, with every column ``product_db`` exports.
+        """
+        row = dict([(field, "") for field in product_db.fieldnames])
+        row.update({
+            product_db.TITLE: title,
+            product_db.CONTENT: title,
+            product_db.DESCRIPTION: title,
+            product_db.CATEGORY: "Clothing",
+            product_db.SUB_CATEGORY: title + "s",
+            product_db.SKU: sku,
+            "Size": size,
+            product_db.NUM_IN_STOCK: stock,
+            product_db.UNIT_PRICE: price,
+            product_db.SALE_PRICE: sale_price,
+            product_db.SALE_START_DATE: sale[0],
+            product_db.SALE_START_TIME: sale[1],
+            product_db.SALE_END_DATE: sale[2],
+            product_db.SALE_END_TIME: sale[3],
+        })
+        return row
+
+    def _path(self):
+        """
+        Returns the path of a new temporary csv file.
+        """
+        handle, path = mkstemp(suffix=".csv")
+        os.close(handle)
+        self._paths.append(path)
+        return path
+
+    def _quietly(self, func, *args, **kwargs):
+        """
+        Calls the function, hiding the progress ``product_db`` prints.
+        """
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+
+    def _write(self, rows):
+        """
+        Writes the rows to a new csv file, returning its path.
+        """
+        path = self._path()
+        with open(path, "w") as f:
+            writer = csv.DictWriter(f, product_db.fieldnames)
+            writer.writerow(dict(zip(product_db.fieldnames,
+                                     product_db.fieldnames)))
+            writer.writerows(rows)
+        return path
+
+    def _import(self, rows, **options):
+        """
+        Imports the rows with ``product_db``.
+        """
+        options["import"] = True
+        self._quietly(call_command, "product_db", self._write(rows),
+                      **options)
+
+    def _variations(self):
+        """
+        Returns the imported variation fields by SKU.
+        """
+        fields = ("product__title", "option1", "num_in_stock",
+                  "unit_price", "sale_price")
+        variations = ProductVariation.objects.values_list("sku", *fields)
+        return dict([(v[0], v[1:]) for v in variations])
+
+    def test_import(self):
+        """
+        Test that importing creates a variation for each row, with its
+        product, categories and options.
+        """
+        self._import(self._rows)
+        self.assertEqual(self._variations(), {
+            "shirt-s": ("Shirt", "Small", 5, Decimal("20"), Decimal("15")),
+            "shirt-l": ("Shirt", "Large", 3, Decimal("20"), None),
+            "hat": ("Hat", None, None, Decimal("10"), None),
+        })
+        shirt = Product.objects.get(title="Shirt")
+        self.assertEqual(shirt.variations.get(default=True).sku, "shirt-s")
+        self.assertEqual(shirt.unit_price, Decimal("20"))
+        self.assertEqual(set(shirt.categories.values_list("title", flat=True)),
+                         set(["Shirts", "Shop"]))
+        sizes = ProductOption.objects.filter(type=1).values_list("name",
+                                                                 flat=True)
+        self.assertEqual(set(sizes), set(["Small", "Large"]))
+        # Importing an existing SKU fails without ``--sync``.
+        self.assertRaises(CommandError, self._quietly,
+                          product_db.import_products,
+                          self._write(self._rows[:1]))
+
+    def test_sync(self):
+        """
+        Test that syncing updates the fields changed for existing SKUs,
+        including removing a sale, and copies the changes onto the
+        product when its default variation changes.
+        """
+        self._import(self._rows)
+        shirt_s, shirt_l, hat = self._rows
+        shirt_s = self._row("Shirt", "shirt-s", size="Small", stock="5",
+                            price="20.00")
+        shirt_l[product_db.NUM_IN_STOCK] = "0"
+        shirt_l[product_db.UNIT_PRICE] = "25.00"
+        self._import([shirt_s, shirt_l, hat], sync=True)
+        self.assertEqual(self._variations(), {
+            "shirt-s": ("Shirt", "Small", 5, Decimal("20"), None),
+            "shirt-l": ("Shirt", "Large", 0, Decimal("25"), None),
+            "hat": ("Hat", None, None, Decimal("10"), None),
+        })
+        shirt = Product.objects.get(title="Shirt")
+        self.assertEqual(shirt.sale_price, None)
+        self.assertEqual(shirt.sale_from, None)
+        self.assertEqual(shirt.price(), Decimal("20"))
+        self.assertEqual(Product.objects.count(), 2)
+
+    def _by_sku(self, rows):
+        """
+        Returns the rows by SKU, with prices as decimals since their
+        precision when exported depends on the database.
+        """
+        by_sku = {}
+        for row in rows:
+            row = dict(row)
+            for field in (product_db.UNIT_PRICE, product_db.SALE_PRICE):
+                if row[field]:
+                    row[field] = Decimal(row[field])
+            by_sku[row[product_db.SKU]] = row
+        return by_sku
+
+    def _export(self, **options):
+        """
+        Exports with ``product_db``, returning the rows by SKU.
+        """
+        path = self._path()
+        options["export"] = True
+        self._quietly(call_command, "product_db", path, **options)
+        with open(path) as f:
+            return self._by_sku(csv.DictReader(f))
+
+    def test_export(self):
+        """
+        Test that exporting writes back the rows imported, and then the
+        changes synced, when reading the variations in chunks.
+        """
+        self._import(self._rows)
+        self.assertEqual(self._export(), self._by_sku(self._rows))
+        hat = self._rows[2]
+        hat[product_db.NUM_IN_STOCK] = "7"
+        self._import([hat], sync=True)
+        self.assertEqual(self._export(chunk_size=1),
+                         self._by_sku(self._rows))
+
+    def test_import_workers(self):
+        """
+        Test that importing with worker processes, and then syncing
+        with them, gives the same rows as importing in one process.
+        """
+        if connection.settings_dict["NAME"] == ":memory:":
+            self.skipTest("Worker processes can't share an in-memory "
+                          "database.")
+        self._import(self._rows, workers=2, chunk_size=1)
+        self.assertEqual(self._export(), self._by_sku(self._rows))
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(CategoryProduct.objects.filter(
+            category__title="Shirts").count(), 1)
+        hat = self._rows[2]
+        hat[product_db.NUM_IN_STOCK] = "7"
+        self._import(self._rows, sync=True, workers=2, chunk_size=1)
+        self.assertEqual(self._export(), self._by_sku(self._rows))
@@ -7,6 +7,7 @@ except ImportError:
     from md5 import new as digest
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
 from django.utils.translation import ugettext as _
 
 from mezzanine.conf import settings
@@ -19,15 +20,157 @@ def make_choices(choices):
     return zip(choices, choices)
 
 
+class KeysetPaginator(object):
+    """
+    Stands in for ``django.core.paginator.Paginator`` on a
+    ``KeysetPage``, given a total count that can be cached or
+    approximate rather than calculated for each page.
+    """
+
+    def __init__(self, count, per_page):
+        self.count = count
+        self.num_pages = max(1, (count + per_page - 1) // per_page)
+
+
+class KeysetPage(object):
+    """
+    A page of objects retrieved by seeking from the first or last
+    object of an adjacent page, rather than by offset. Provides the
+    same interface as ``django.core.paginator.Page`` for templates,
+    along with the IDs of the first and last objects to link to the
+    previous and next pages with.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list, number, paginator, has_previous,
+                 has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def previous_page_number(self):
+        return max(1, self.number - 1)
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def first_id(self):
+        return self.object_list[0].id if self.object_list else None
+
+    def last_id(self):
+        return self.object_list[-1].id if self.object_list else None
+
+
+def seek(objects, sort_by, cursor=None, forwards=True, limit=None):
+    """
+    Returns a list of up to ``limit`` objects from the queryset
+    ordered by the ``sort_by`` field and then ID, that follow (or
+    precede when ``forwards`` is ``False``) the position given by
+    ``cursor``, a pair of the sort field value and ID. Objects with
+    a null sort field value are ordered after all others by ID, so
+    the order is the same across database backends. Each query is an
+    indexable range comparison with a limit, so the cost doesn't grow
+    with the position in the results.
+    """
+    field = sort_by.lstrip("-")
+    descending = sort_by.startswith("-") == forwards
+    direction = "-" if descending else ""
+    op = "__lt" if descending else "__gt"
+    null = field + "__isnull"
+    segments = [
+        (False, objects.filter(**{null: False}).order_by(direction + field,
+                                                          direction + "id")),
+        (True, objects.filter(**{null: True}).order_by(direction + "id")),
+    ]
+    if not forwards:
+        segments.reverse()
+    results = []
+    for is_null, queryset in segments:
+        if cursor is not None:
+            value, pk = cursor
+            if (value is None) != is_null:
+                # The cursor is in a later segment.
+                continue
+            if is_null:
+                queryset = queryset.filter(**{"id" + op: pk})
+            else:
+                queryset = queryset.filter(Q(**{field + op: value}) |
+                                           Q(**{field: value, "id" + op: pk}))
+            cursor = None
+        if limit is None:
+            results.extend(queryset)
+        else:
+            results.extend(queryset[:limit - len(results)])
+            if len(results) >= limit:
+                break
+    if not forwards:
+        results.reverse()
+    return results
+
+
+def paginate_keyset(objects, sort_by, query, per_page, count):
+    """
+    Keyset version of ``mezzanine.utils.views.paginate``, returning a
+    ``KeysetPage``. The page is positioned from the ``after`` or
+    ``before`` object IDs in the ``query`` dict, with ``page`` only
+    used for display.
+    """
+    try:
+        number = max(1, int(query.get("page", 1)))
+    except ValueError:
+        number = 1
+    field = sort_by.lstrip("-")
+    forwards = "before" not in query
+    cursor = query.get("after" if forwards else "before")
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+            lookup = objects.model.objects.filter(id=cursor)
+            cursor = (lookup.values_list(field, flat=True)[0], cursor)
+        except (IndexError, ValueError):
+            cursor = None
+    if cursor is None:
+        number, forwards = 1, True
+    object_list = seek(objects, sort_by, cursor, forwards, per_page + 1)
+    more = len(object_list) > per_page
+    if forwards:
+        object_list = object_list[:per_page]
+        has_previous, has_next = cursor is not None, more
+    else:
+        object_list = object_list[-per_page:]
+        has_previous, has_next = more, True
+    paginator = KeysetPaginator(count, per_page)
+    return KeysetPage(object_list, number, paginator, has_previous, has_next)
+
+
 def recalculate_discount(request):
     """
     Updates an existing discount code when the cart is modified.
+    The cart bound to the request is expected to reflect the
+    modification, so that it isn't retrieved again.
     """
     from cartridge.shop.forms import DiscountForm
-    from cartridge.shop.models import Cart
-    # Rebind the cart to request since it's been modified.
-    request.cart = Cart.objects.from_request(request)
     discount_code = request.session.get("discount_code", "")
+    if not discount_code:
+        return
     discount_form = DiscountForm(request, {"discount_code": discount_code})
     if discount_form.is_valid():
         discount_form.set_discount()
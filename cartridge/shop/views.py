@@ -15,8 +15,8 @@ from mezzanine.utils.views import render, set_cookie
 
 from cartridge.shop import checkout
 from cartridge.shop.forms import AddProductForm, DiscountForm, CartItemFormSet
-from cartridge.shop.models import Product, ProductVariation, Order
-from cartridge.shop.models import DiscountCode
+from cartridge.shop.models import Cart, Product, ProductVariation, Order
+from cartridge.shop.models import CategoryProduct, DiscountCode
 from cartridge.shop.utils import recalculate_discount, sign
 
 
@@ -32,11 +32,17 @@ def product(request, slug, template="shop/product.html"):
     Display a product - convert the product variations to JSON as well as
     handling adding the product to either the cart or the wishlist.
     """
-    published_products = Product.objects.published(for_user=request.user)
-    product = get_object_or_404(published_products, slug=slug)
+    CategoryProduct.objects.update_sales()
+    try:
+        details = Product.objects.details(slug, for_user=request.user)
+    except Product.DoesNotExist:
+        raise Http404
+    product = details["product"]
     to_cart = (request.method == "POST" and
                request.POST.get("add_wishlist") is None)
     add_product_form = AddProductForm(request.POST or None, product=product,
+                                      variations=details["variations"],
+                                      options=details["options"],
                                       initial={"quantity": 1}, to_cart=to_cart)
     if request.method == "POST":
         if add_product_form.is_valid():
@@ -55,19 +61,19 @@ def product(request, slug, template="shop/product.html"):
                 response = redirect("shop_wishlist")
                 set_cookie(response, "wishlist", ",".join(skus))
                 return response
-    fields = [f.name for f in ProductVariation.option_fields()]
-    fields += ["sku", "image_id"]
-    variations = product.variations.all()
-    variations_json = simplejson.dumps([dict([(f, getattr(v, f))
-                                        for f in fields])
-                                        for v in variations])
+    variations = details["variations"]
+    variations_json = []
+    for v, variation in zip(variations, details["variations_json"]):
+        variation = dict(variation, num_in_stock=v.live_num_in_stock())
+        variations_json.append(variation)
+    variations_json = simplejson.dumps(variations_json)
     context = {
         "product": product,
-        "images": product.images.all(),
+        "images": details["images"],
         "variations": variations,
         "variations_json": variations_json,
         "has_available_variations": any([v.has_price() for v in variations]),
-        "related": product.related_products.published(for_user=request.user),
+        "related": details["related"],
         "add_product_form": add_product_form
     }
     return render(request, template, context)
@@ -79,6 +85,7 @@ def wishlist(request, template="shop/wishlist.html"):
     adding them to the cart.
     """
 
+    CategoryProduct.objects.update_sales()
     skus = request.wishlist
     error = None
     if request.method == "POST":
@@ -110,6 +117,8 @@ def wishlist(request, template="shop/wishlist.html"):
     f = {"product__in": published_products, "sku__in": skus}
     wishlist = ProductVariation.objects.filter(**f).select_related(depth=1)
     wishlist = sorted(wishlist, key=lambda v: skus.index(v.sku))
+    for variation in wishlist:
+        variation.in_stock = variation.has_stock()
     context = {"wishlist_items": wishlist, "error": error}
     response = render(request, template, context)
     if len(wishlist) < len(skus):
@@ -122,6 +131,8 @@ def cart(request, template="shop/cart.html"):
     """
     Display cart and handle removing items from the cart.
     """
+    CategoryProduct.objects.update_sales()
+    request.cart = request.cart.store()
     cart_formset = CartItemFormSet(instance=request.cart)
     discount_form = DiscountForm(request, request.POST or None)
     if request.method == "POST":
@@ -137,6 +148,8 @@ def cart(request, template="shop/cart.html"):
                 valid = cart_formset.is_valid()
                 if valid:
                     cart_formset.save()
+                    # Rebind the cart to request with its new totals.
+                    request.cart = Cart.objects.get(id=request.cart.id)
                     recalculate_discount(request)
                     info(request, _("Cart updated"))
         else:
@@ -165,6 +178,8 @@ def checkout_steps(request):
     if settings.SHOP_CHECKOUT_ACCOUNT_REQUIRED and not authenticated:
         url = "%s?next=%s" % (settings.LOGIN_URL, reverse("shop_checkout"))
         return redirect(url)
+    CategoryProduct.objects.update_sales()
+    request.cart = request.cart.store()
 
     # Determine the Form class to use during the checkout process
     form_class = get_callable(settings.SHOP_CHECKOUT_FORM_CLASS)
@@ -207,20 +222,35 @@ def checkout_steps(request):
             if step == checkout.CHECKOUT_STEP_LAST and not checkout_errors:
                 # Create and save the inital order object so that
                 # the payment handler has access to all of the order
-                # fields. If there is a payment error then delete the
-                # order, otherwise remove the cart items from stock
-                # and send the order reciept email.
+                # fields. Remove the order's items from stock before
+                # payment so they can't be sold twice. If there isn't
+                # enough stock or there is a payment error then delete
+                # the order and restore the stock, otherwise send the
+                # order reciept email.
                 order = form.save(commit=False)
                 order.setup(request)
-                # Try payment.
+                # Reserve stock and try payment.
                 try:
+                    out_of_stock = order.reserve_stock()
+                    if out_of_stock:
+                        items = order.items.filter(sku__in=out_of_stock)
+                        raise checkout.CheckoutError(_("The following "
+                            "items don't have enough stock: %s") %
+                            ", ".join([item.description for item in items]))
                     transaction_id = payment_handler(request, form, order)
                 except checkout.CheckoutError, e:
-                    # Error in payment handler.
+                    # Not enough stock, or error in payment handler.
+                    order.release_stock()
                     order.delete()
                     checkout_errors.append(e)
                     if settings.SHOP_CHECKOUT_STEPS_CONFIRMATION:
                         step -= 1
+                except:
+                    # Unexpected error in payment handler - restore
+                    # the stock and remove the order before raising it.
+                    order.release_stock()
+                    order.delete()
+                    raise
                 else:
                     # Finalize order - ``order.complete()`` performs
                     # final cleanup of session and cart.
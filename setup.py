@@ -38,6 +38,7 @@ try:
         packages=find_packages(),
 
         install_requires=[
+            "django >= 1.4",
             "mezzanine >= 1.0.8",
             "pisa >= 3.0.33",
         ],